@@ -0,0 +1,193 @@
+"""
+End-to-end benchmark for EnhancedMultiAgentSystem.run_enhanced_interaction.
+
+Drives the interaction headlessly against synthetic projects of increasing
+size using the local stand-in backend, and records per-phase timings and peak
+memory for every turn. Results are written as JSON so runs from different
+versions can be compared with --compare.
+
+    python benchmark.py --sizes 10 100 1000 --images 0 10 50 --output bench_results.json
+    python benchmark.py --compare bench_results_old.json --output bench_results.json
+"""
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from PIL import Image
+
+import gemini_app
+
+PHASES = ["prompt_enhancement", "context_preflight", "context_build", "main_call", "command", "critics", "refinement"]
+
+DEFAULT_PROMPT = "Implement a settings page with a visual design review of the UI layout"
+
+# Main Coder response used for every turn: a few files plus enough changes to trigger both critics
+MAIN_CODER_SCRIPT = (
+    "`create_file('bench/settings.py', '''def load_settings():\n    return {\"theme\": \"dark\"}\n''')`\n"
+    "`create_file('bench/settings.html', '<div class=\"settings\">Settings UI layout</div>')`\n"
+    "`write_to_file('bench/settings.py', '''def load_settings():\n    return {\"theme\": \"light\"}\n''')`"
+)
+
+
+def create_synthetic_project(root, file_count, image_count, image_size=(1920, 1080)):
+    """Fill root with file_count text files and image_count PNG screenshots."""
+    root.mkdir(parents=True, exist_ok=True)
+    for i in range(file_count):
+        module_dir = root / f"pkg{i % 10}"
+        module_dir.mkdir(exist_ok=True)
+        body = "\n".join(
+            f"def function_{i}_{n}(value):\n    return value * {n}  # synthetic line {n}\n"
+            for n in range(40)
+        )
+        (module_dir / f"module_{i}.py").write_text(body, encoding="utf-8")
+
+    for i in range(image_count):
+        gradient = Image.linear_gradient("L").resize(image_size)
+        img = Image.merge("RGB", (gradient, gradient.rotate(90), gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+        img.save(root / f"screenshot_{i}.png", "PNG")
+
+
+def summarize_phases(spans):
+    """Total seconds and span count per phase; command:<handler> spans roll up into "command"."""
+    summary = {phase: {"seconds": 0.0, "count": 0} for phase in PHASES}
+    for span in spans:
+        phase = "command" if span["name"].startswith("command:") else span["name"]
+        if phase not in summary:
+            continue  # Nested model calls and per-critic spans are covered by their phase
+        summary[phase]["seconds"] += span["duration"]
+        summary[phase]["count"] += 1
+    for entry in summary.values():
+        entry["seconds"] = round(entry["seconds"], 4)
+    return summary
+
+
+def run_scenario(file_count, image_count, turns, prompt, backend_options, workdir, trace_dir=None):
+    """Run `turns` interactions against one synthetic project and return per-turn results."""
+    project_dir = workdir / f"project_{file_count}_{image_count}"
+    create_synthetic_project(project_dir, file_count, image_count)
+
+    options = {"scripts": {"main_coder": [MAIN_CODER_SCRIPT]}, **backend_options}
+    engine = gemini_app.EnhancedMultiAgentSystem(None, backend="local", backend_options=options)
+    session = engine.create_session(project_dir)
+    # Keep caches inside the scenario so every scenario starts cold
+    session.snapshot_cache.image_preparer.cache_dir = workdir / f"cache_{file_count}_{image_count}" / "images"
+    engine.response_cache.cache_dir = workdir / f"cache_{file_count}_{image_count}" / "responses"
+    engine.max_retry_attempts = 1
+
+    results = []
+    for turn in range(1, turns + 1):
+        tracemalloc.start()
+        start = time.perf_counter()
+        event_count = sum(1 for _ in engine.run_enhanced_interaction(prompt, session))
+        total = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results.append({
+            "files": file_count,
+            "images": image_count,
+            "turn": turn,
+            "total_seconds": round(total, 4),
+            "peak_memory_mb": round(peak / (1024 * 1024), 2),
+            "events": event_count,
+            "phases": summarize_phases(session.tracer.sorted_spans()),
+        })
+        if trace_dir:
+            Path(trace_dir).mkdir(parents=True, exist_ok=True)
+            session.tracer.export_chrome_trace(Path(trace_dir) / f"trace_{file_count}_{image_count}_{turn}.json")
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, cwd=Path(__file__).parent, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_results(results):
+    header = f"{'files':>6} {'images':>6} {'turn':>4} {'total':>8} " + " ".join(f"{p[:12]:>12}" for p in PHASES) + f" {'peak MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        phases = " ".join(f"{result['phases'][p]['seconds']:>12.3f}" for p in PHASES)
+        print(f"{result['files']:>6} {result['images']:>6} {result['turn']:>4} {result['total_seconds']:>8.3f} {phases} {result['peak_memory_mb']:>8.2f}")
+
+
+def print_comparison(baseline, results):
+    """Print per-phase deltas against a previous benchmark file."""
+    previous = {(r["files"], r["images"], r["turn"]): r for r in baseline.get("results", [])}
+    print(f"\nComparison against {baseline.get('meta', {}).get('revision') or 'baseline'}:")
+    for result in results:
+        old = previous.get((result["files"], result["images"], result["turn"]))
+        if not old:
+            continue
+        deltas = []
+        for phase in ["total"] + PHASES:
+            new_value = result["total_seconds"] if phase == "total" else result["phases"][phase]["seconds"]
+            old_value = old["total_seconds"] if phase == "total" else old["phases"].get(phase, {}).get("seconds", 0.0)
+            if old_value:
+                deltas.append(f"{phase} {(new_value - old_value) / old_value * 100:+.0f}%")
+        print(f"  files={result['files']} images={result['images']} turn={result['turn']}: " + ", ".join(deltas))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark run_enhanced_interaction phases on synthetic projects")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="Text file counts to test")
+    parser.add_argument("--images", type=int, nargs="+", default=[0, 10, 50], help="Image counts to test")
+    parser.add_argument("--turns", type=int, default=2, help="Interactions per project (first is cold, rest warm)")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT)
+    parser.add_argument("--latency", type=float, default=0.0, help="Stand-in model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--output", default="bench_results.json", help="Machine-readable results file")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic projects after the run")
+    parser.add_argument("--trace-dir", help="Also write a Chrome trace of every turn to this directory")
+    args = parser.parse_args(argv)
+
+    backend_options = {"latency": args.latency, "jitter": args.jitter, "seed": 0, "chunk_latency": 0.0}
+    workdir = Path(tempfile.mkdtemp(prefix="gemini_bench_"))
+    results = []
+    try:
+        for file_count in args.sizes:
+            for image_count in args.images:
+                print(f"Running {file_count} files / {image_count} images...", file=sys.stderr)
+                results.extend(run_scenario(
+                    file_count, image_count, args.turns, args.prompt, backend_options, workdir, args.trace_dir
+                ))
+    finally:
+        if args.keep:
+            print(f"Synthetic projects kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": vars(args),
+        },
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    print_results(results)
+    if args.compare:
+        print_comparison(json.loads(Path(args.compare).read_text(encoding="utf-8")), results)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
 
 import os
+import sys
+import io
+import asyncio
+import contextvars
+import hashlib
+import json
 import threading
 import queue
 import subprocess
@@ -7,13 +13,23 @@ import ast
 import configparser
 import time
 import re
+import math
+import random
+import heapq
 import shutil
+import argparse
+import tempfile
 import tkinter as tk
 from tkinter import ttk, simpledialog, messagebox, scrolledtext
 from pathlib import Path
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
 
 # Third-party imports
-from PIL import Image, ImageTk
+from PIL import Image, ImageTk, features
 
 # pip install google-genai Pillow
 try:
@@ -28,9 +44,41 @@ except ImportError:
 # -----------------------------------------------------------------------------
 CONFIG_PATH = Path('config.ini')
 VM_DIR = Path('vm')
+CACHE_DIR = Path('.cache')
 APP_TITLE = "Enhanced Multi-Agent IDE"
 TEXT_MODEL_NAME = "gemini-2.5-flash-preview-05-20"
+BACKEND = os.environ.get("GEMINI_BACKEND", "gemini")  # "gemini" for the live API, "local" for the offline stand-in
 IMAGE_MODEL_NAME = "gemini-2.0-flash-preview-image-generation"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+IMAGE_MAX_EDGE = 1024  # Longest edge, in pixels, of images sent to the model
+IMAGE_CONCURRENCY = 4  # Image generation requests in flight at once, across all sessions
+IMAGE_REQUESTS_PER_MINUTE = 10  # Image model quota shared by all sessions
+CONTEXT_TOKEN_BUDGET = 32000  # Default prompt budget for the Main Coder's project context
+DELTA_CONTEXT_REBASE_RATIO = 0.5  # Changed-file tokens, as a share of the cached snapshot, that trigger a new snapshot
+RESPONSE_CACHE_MAX_BYTES = 200 * 1024 * 1024  # On-disk response cache size before LRU eviction
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # Seconds before a cached response expires
+CONTEXT_CACHE_MIN_TOKENS = 1024  # Smallest prompt prefix the API accepts for context caching
+CONTEXT_CACHE_TTL = 900  # Seconds a cached prompt prefix lives on the server
+
+# Agent roles whose model calls can be served from the response cache
+AGENT_ROLES = {
+    "prompt_enhancer": "✨ Prompt Enhancer",
+    "main_coder": "🤖 Main Coder",
+    "code_critic": "📊 Code Critic",
+    "art_critic": "🎭 Art Critic",
+    "combined_critic": "🧾 Combined Critic",
+    "collaborative": "🤝 Collaborative",
+    "image_generator": "🎨 Image Generator",
+}
+
+# Chat colors for each agent's messages
+AGENT_COLORS = {
+    "🤖 Main Coder": "#2E8B57",
+    "📊 Code Critic": "#FF6347",
+    "🎭 Art Critic": "#9370DB",
+    "✨ Prompt Enhancer": "#FFD700", # Gold color for enhancer
+    "🤝 Collaborative": "#4169E1"
+}
 
 # Enhanced Agent System Prompts with Grading System
 MAIN_AGENT_PROMPT = """You are the PRIMARY CODER AGENT in an advanced multi-agent IDE system. Your role is to implement code, execute commands, and coordinate with other agents.
@@ -142,6 +190,19 @@ Then provide comprehensive artistic guidance including:
 Assess both aesthetic quality and functional usability. Consider accessibility, user experience, and technical implementation quality.
 """
 
+COMBINED_CRITIQUE_PROMPT = """You are performing a COMBINED CRITIQUE for an advanced multi-agent IDE system: you act as both the Code Critique Agent and the Art Critique Agent for the same implementation, in a single response.
+
+Review the implementation twice, once under each rubric below, and keep the two reviews independent. Each review must follow its own mandatory response format, including its own grade.
+
+**MANDATORY RESPONSE FORMAT:**
+=== CODE CRITIQUE ===
+(the complete code critique, starting with **GRADE: [score]/100**)
+=== ART CRITIQUE ===
+(the complete art critique, starting with **GRADE: [score]/100**)
+
+Use each marker exactly once, on its own line, in this order.
+"""
+
 PROMPT_ENHANCER_AGENT_PROMPT = """You are a PROMPT ENHANCER AGENT. Your role is to take a user's raw prompt and transform it into a more detailed, specific, and well-structured prompt that is optimized for large language models (LLMs) and image generation models. Your *sole* responsibility is to refine and rephrase the user's input to be a better prompt for a different AI. You do not answer or execute any part of the user's request.
 
 **TASK:**
@@ -192,22 +253,1464 @@ def save_api_key(key):
     with open(CONFIG_PATH, 'w') as f:
         config.write(f)
 
+# -----------------------------------------------------------------------------
+# Local Stand-in Backend
+# -----------------------------------------------------------------------------
+class LocalBackendError(Exception):
+    """Failure injected by the local stand-in backend."""
+
+
+class LocalGeminiClient:
+    """Offline stand-in for genai.Client used for profiling and load tests.
+
+    Responses come from per-role scripts (cycled in order) or built-in
+    templates, where {request} is replaced by the user request text. The role
+    is detected from the agent system prompt contained in the request, and
+    image-model calls return a generated PNG as inline data. Latency, jitter
+    and failure rate are configurable so pipeline timings can be measured
+    without a network. Cached content is emulated in memory: cached tokens are
+    reported in the usage metadata and do not add to the per-token latency.
+    """
+    DEFAULT_TEMPLATES = {
+        "prompt_enhancer": ["{request}"],
+        "main_coder": [
+            "`create_file('standin_output.py', '''# Generated by the local stand-in backend\n"
+            "def main():\n    print(\"Hello from the stand-in\")\n\n\n"
+            "if __name__ == \"__main__\":\n    main()\n''')`"
+        ],
+        "code_critic": [
+            "**GRADE: 82/100**\n\n- **Priority Level**: Low\n- **Category**: Maintainability\n"
+            "- **Specific Issue**: Stand-in review of the implementation.\n"
+            "- **Recommended Solution**: No action required."
+        ],
+        "art_critic": [
+            "**GRADE: 78/100**\n\n- **Visual Assessment**: Stand-in review of the visual elements.\n"
+            "- **Design Recommendations**: No action required."
+        ],
+        "collaborative": ["Stand-in refinement suggestions: none."],
+        "image_generator": ["Generated image for: {request}"],
+    }
+    ROLE_MARKERS = [
+        ("COMBINED CRITIQUE", "combined_critic"),
+        ("PROMPT ENHANCER AGENT", "prompt_enhancer"),
+        ("CODE CRITIQUE AGENT", "code_critic"),
+        ("ART CRITIQUE AGENT", "art_critic"),
+        ("PRIMARY CODER AGENT", "main_coder"),
+    ]
+    REQUEST_MARKERS = ("**USER REQUEST:**", "ORIGINAL REQUEST:", "Now, enhance the following user prompt:")
+
+    def __init__(self, scripts=None, latency=0.5, jitter=0.1, failure_rate=0.0,
+                 stream_chunk_chars=40, chunk_latency=0.02, image_size=(256, 256), seed=None,
+                 input_latency_per_1k=0.0):
+        self.templates = {role: list(responses) for role, responses in self.DEFAULT_TEMPLATES.items()}
+        self.templates.update({role: list(responses) for role, responses in (scripts or {}).items()})
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.stream_chunk_chars = stream_chunk_chars
+        self.chunk_latency = chunk_latency
+        self.input_latency_per_1k = input_latency_per_1k
+        self.image_size = tuple(image_size)
+        self.call_counts = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.models = self  # Mirrors genai.Client.models
+        self.caches = LocalCaches(self)
+        self.aio = LocalAsyncModels(self)
+
+    @classmethod
+    def from_script_file(cls, path, **options):
+        """Load per-role responses and optional settings from a JSON file.
+
+        The file looks like {"responses": {"main_coder": ["..."]}, "options": {"latency": 1.0}}.
+        """
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+        options = {**data.get("options", {}), **options}
+        return cls(scripts=data.get("responses", {}), **options)
+
+    def _flatten_text(self, contents):
+        """Concatenate the text parts of a request."""
+        if isinstance(contents, str):
+            return contents
+        texts = []
+        for part in contents if isinstance(contents, list) else [contents]:
+            if isinstance(part, str):
+                texts.append(part)
+            elif isinstance(part, dict) and "text" in part:
+                texts.append(part["text"])
+            elif isinstance(part, types.Content):
+                texts.extend(item.text for item in part.parts or [] if item.text)
+        return "".join(texts)
+
+    def _detect_role(self, model, text):
+        if model == IMAGE_MODEL_NAME:
+            return "image_generator"
+        for marker, role in self.ROLE_MARKERS:
+            if marker in text:
+                return role
+        return "collaborative"
+
+    def _extract_request(self, text):
+        for marker in self.REQUEST_MARKERS:
+            if marker in text:
+                return text.rsplit(marker, 1)[1].strip().split("\n\n")[0].strip()
+        return text.strip()
+
+    def _next_response_text(self, role, request):
+        if role == "combined_critic" and "combined_critic" not in self.templates:
+            # Answer in the combined format from the individual critics' scripts
+            return (f"=== CODE CRITIQUE ===\n{self._next_response_text('code_critic', request)}\n"
+                    f"=== ART CRITIQUE ===\n{self._next_response_text('art_critic', request)}")
+        with self._lock:
+            count = self.call_counts.get(role, 0)
+            self.call_counts[role] = count + 1
+        responses = self.templates.get(role) or [""]
+        return responses[count % len(responses)].replace("{request}", request)
+
+    def _draw_latency(self):
+        """Pick the delay for one call and whether a failure is injected."""
+        with self._lock:
+            delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+            failed = self._random.random() < self.failure_rate
+        return max(0.0, delay), failed
+
+    def _simulate_latency(self):
+        """Sleep for the configured latency and raise if a failure is injected."""
+        delay, failed = self._draw_latency()
+        time.sleep(delay)
+        if failed:
+            raise LocalBackendError("Injected failure from local stand-in backend")
+
+    def _placeholder_png(self, prompt):
+        """Solid-color PNG whose color is derived from the prompt."""
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        buffer = io.BytesIO()
+        Image.new("RGB", self.image_size, tuple(digest[:3])).save(buffer, "PNG")
+        return buffer.getvalue()
+
+    def _build_response(self, text, prompt_text, image_bytes=None, cached_tokens=0):
+        parts = [types.Part(text=text)]
+        if image_bytes is not None:
+            parts.append(types.Part(inline_data=types.Blob(mime_type="image/png", data=image_bytes)))
+        prompt_tokens = ContextPacker.estimate_text_tokens(prompt_text) + cached_tokens
+        output_tokens = ContextPacker.estimate_text_tokens(text)
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=parts))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=output_tokens,
+                total_token_count=prompt_tokens + output_tokens,
+                cached_content_token_count=cached_tokens or None,
+            ),
+        )
+
+    def _respond(self, model, contents, config=None):
+        """Build the scripted response for a request (latency already applied)."""
+        prompt_text = self._flatten_text(contents)
+        cached_text, cached_tokens = "", 0
+        if getattr(config, "cached_content", None):
+            cache = self.caches.lookup(config.cached_content)
+            cached_text, cached_tokens = cache["text"], cache["tokens"]
+        role = self._detect_role(model, cached_text + prompt_text)
+        request = self._extract_request(cached_text + prompt_text)
+        text = self._next_response_text(role, request)
+        image_bytes = self._placeholder_png(request) if role == "image_generator" else None
+        return self._build_response(text, prompt_text, image_bytes, cached_tokens)
+
+    def _input_delay(self, response):
+        """Extra latency for the uncached input tokens of a response."""
+        usage = response.usage_metadata
+        uncached = (usage.prompt_token_count or 0) - (usage.cached_content_token_count or 0)
+        return uncached / 1000 * self.input_latency_per_1k
+
+    def _split_stream(self, response):
+        """Split a finished response into stream chunks."""
+        text = response.text or ""
+        starts = range(0, len(text), self.stream_chunk_chars)
+        for start in starts:
+            chunk = text[start:start + self.stream_chunk_chars]
+            # Like the live API, only the final chunk reports the total usage
+            is_last = start == starts[-1]
+            yield types.GenerateContentResponse(
+                candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=chunk)]))],
+                usage_metadata=response.usage_metadata if is_last else None,
+            )
+
+    def generate_content(self, model, contents, config=None):
+        self._simulate_latency()
+        response = self._respond(model, contents, config)
+        time.sleep(self._input_delay(response))
+        return response
+
+    def generate_content_stream(self, model, contents, config=None):
+        response = self.generate_content(model, contents, config)
+        for index, chunk in enumerate(self._split_stream(response)):
+            if index:
+                time.sleep(self.chunk_latency)
+            yield chunk
+
+
+class LocalAsyncModels:
+    """Async side of the stand-in backend, mirroring genai.Client.aio.models."""
+
+    def __init__(self, client):
+        self.client = client
+        self.models = self  # Mirrors genai.Client.aio.models
+        self.caches = LocalAsyncCaches(client.caches)
+
+    async def generate_content(self, model, contents, config=None):
+        delay, failed = self.client._draw_latency()
+        await asyncio.sleep(delay)
+        if failed:
+            raise LocalBackendError("Injected failure from local stand-in backend")
+        response = self.client._respond(model, contents, config)
+        await asyncio.sleep(self.client._input_delay(response))
+        return response
+
+    async def generate_content_stream(self, model, contents, config=None):
+        response = await self.generate_content(model, contents, config)
+        return self._stream(response)
+
+    async def _stream(self, response):
+        for index, chunk in enumerate(self.client._split_stream(response)):
+            if index:
+                await asyncio.sleep(self.client.chunk_latency)
+            yield chunk
+
+
+class LocalCaches:
+    """In-memory stand-in for genai.Client.caches."""
+
+    def __init__(self, client):
+        self.client = client
+        self.entries = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def create(self, model, config):
+        text = self.client._flatten_text(list(config.contents or []))
+        images = sum(
+            1 for content in config.contents or [] for part in content.parts or [] if part.inline_data is not None
+        )
+        tokens = ContextPacker.estimate_text_tokens(text) + images * ContextPacker.IMAGE_TILE_TOKENS
+        ttl = float(str(config.ttl or f"{CONTEXT_CACHE_TTL}s").rstrip("s"))
+        with self._lock:
+            name = f"cachedContents/local-{self._next_id}"
+            self._next_id += 1
+            self.entries[name] = {"model": model, "text": text, "tokens": tokens, "expires": time.time() + ttl}
+        return self._describe(name)
+
+    def lookup(self, name):
+        """Cache entry for name; raises like the API for unknown or expired caches."""
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is None or entry["expires"] < time.time():
+                self.entries.pop(name, None)
+                raise LocalBackendError(f"Cached content {name} not found")
+            return entry
+
+    def get(self, name):
+        self.lookup(name)
+        return self._describe(name)
+
+    def delete(self, name):
+        with self._lock:
+            self.entries.pop(name, None)
+
+    def _describe(self, name):
+        entry = self.entries[name]
+        return types.CachedContent(
+            name=name,
+            model=entry["model"],
+            expire_time=datetime.fromtimestamp(entry["expires"], timezone.utc),
+            usage_metadata=types.CachedContentUsageMetadata(total_token_count=entry["tokens"]),
+        )
+
+
+class LocalAsyncCaches:
+    """Async side of LocalCaches, mirroring genai.Client.aio.caches."""
+
+    def __init__(self, caches):
+        self.caches = caches
+
+    async def create(self, model, config):
+        return self.caches.create(model, config)
+
+    async def get(self, name):
+        return self.caches.get(name)
+
+    async def delete(self, name):
+        self.caches.delete(name)
+
+
+def create_client(api_key, backend=BACKEND, backend_options=None):
+    """Build the model client for the selected backend ("gemini" or "local")."""
+    backend_options = dict(backend_options or {})
+    if backend == "local":
+        script_path = backend_options.pop("script", None) or os.environ.get("GEMINI_LOCAL_SCRIPT")
+        if script_path:
+            return LocalGeminiClient.from_script_file(script_path, **backend_options)
+        return LocalGeminiClient(**backend_options)
+    if backend == "gemini":
+        return genai.Client(api_key=api_key)
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+# -----------------------------------------------------------------------------
+# Command Extraction
+# -----------------------------------------------------------------------------
+# Regex to find function-like calls: command_name(arguments)
+# It looks for a valid identifier, followed by '(', any characters (non-greedy), and then ')'
+# Allows for optional whitespace around the command itself within the backticks.
+COMMAND_PATTERN = re.compile(r'`\s*([a-zA-Z_][\w\.]*\s*\(.*?\))\s*`', re.DOTALL)
+
+class IncrementalCommandExtractor:
+    """Finds complete backticked commands in text that arrives in pieces.
+
+    Matching resumes from the end of the last command found, so feeding a
+    response chunk by chunk yields exactly the same commands, in the same
+    order, as scanning the full response at once.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+
+    def feed(self, text):
+        """Add text and return the command strings completed by it."""
+        self.buffer += text
+        commands = []
+        while True:
+            match = COMMAND_PATTERN.search(self.buffer, self.position)
+            if not match:
+                break
+            self.position = match.end()
+            commands.append(match.group(1).strip()) # The pure command like "create_file(...)"
+        return commands
+
+
+class CommandGraph:
+    """Runs agent commands concurrently where they touch unrelated paths.
+
+    Commands are added in the order the agent wrote them. Each one waits for
+    the earlier commands that touch an overlapping path; run_command, and any
+    other command whose paths are unknown, waits for everything before it and
+    holds back everything after it. At most `workers` commands run at once,
+    and results come out in command order. Commands named in live_commands
+    are the exception: they are throttled by their own limiter instead of the
+    worker pool, and their results are handed out as soon as they arrive.
+    """
+    PATH_COMMANDS = ("create_file", "write_to_file", "delete_file", "generate_image")
+
+    def __init__(self, run_command, workers=4, live_commands=()):
+        self.run_command = run_command  # Async generator function: command string -> results
+        self.live_commands = tuple(live_commands)
+        self._workers = asyncio.Semaphore(max(1, workers))
+        self._events = asyncio.Queue()  # (node, result), with result None once a command has finished
+        self._nodes = []
+        self._touched = []  # (index, paths) of commands since the last barrier
+        self._last_barrier = None
+        self._head = 0  # First node whose results have not all been handed out
+
+    @classmethod
+    def command_paths(cls, command_str):
+        """Normalized project paths a command touches, or None if it must run as a barrier."""
+        try:
+            call_node = ast.parse(command_str, mode="eval").body
+            func_name = call_node.func.id
+        except (SyntaxError, ValueError, AttributeError):
+            return set()  # Rejected by the executor without touching anything
+        if func_name not in cls.PATH_COMMANDS:
+            return None
+        try:
+            path = ast.literal_eval(call_node.args[0])
+            return {os.path.normcase(os.path.normpath(path)).replace("\\", "/")}
+        except (SyntaxError, ValueError, TypeError, IndexError):
+            return set()
+
+    @staticmethod
+    def _overlap(paths, other_paths):
+        return any(
+            path == other or path.startswith(other + "/") or other.startswith(path + "/")
+            for path in paths for other in other_paths
+        )
+
+    def add(self, command_str):
+        """Schedule a command after the earlier commands it depends on."""
+        index = len(self._nodes)
+        paths = self.command_paths(command_str)
+        if paths is None:
+            dependencies = [other_index for other_index, _ in self._touched]
+            self._touched = []
+        else:
+            dependencies = [other_index for other_index, other in self._touched if self._overlap(paths, other)]
+            self._touched.append((index, paths))
+        if self._last_barrier is not None:
+            dependencies.append(self._last_barrier)
+        if paths is None:
+            self._last_barrier = index
+
+        node = {
+            "done": asyncio.Event(), "buffer": [], "finished": False,
+            "live": command_str.split("(", 1)[0].strip() in self.live_commands,
+        }
+        waits = [self._nodes[dependency]["done"] for dependency in dependencies]
+        node["task"] = asyncio.create_task(self._run(node, command_str, waits), name=f"command_{index + 1}")
+        self._nodes.append(node)
+
+    async def _run(self, node, command_str, waits):
+        try:
+            for event in waits:
+                await event.wait()
+            if node["live"]:
+                async for result in self.run_command(command_str):
+                    self._events.put_nowait((node, result))
+            else:
+                async with self._workers:
+                    async for result in self.run_command(command_str):
+                        self._events.put_nowait((node, result))
+        finally:
+            node["done"].set()
+            self._events.put_nowait((node, None))
+
+    def _handle(self, node, result):
+        """Record one event and return the results that can be handed out now."""
+        released = []
+        if result is None:
+            node["finished"] = True
+        elif node["live"]:
+            released.append(result)
+        else:
+            node["buffer"].append(result)
+
+        while self._head < len(self._nodes):
+            head = self._nodes[self._head]
+            released.extend(head["buffer"])
+            head["buffer"] = []
+            if not head["finished"]:
+                break
+            self._head += 1
+        return released
+
+    def ready(self):
+        """Results available now that can be handed out without breaking command order."""
+        released = []
+        while not self._events.empty():
+            released.extend(self._handle(*self._events.get_nowait()))
+        return released
+
+    async def results(self):
+        """Yield the remaining results in command order as the commands finish."""
+        while self._head < len(self._nodes):
+            for result in self._handle(*await self._events.get()):
+                yield result
+
+    async def cancel(self):
+        """Cancel the commands still pending or running and wait until all of them have stopped."""
+        tasks = [node["task"] for node in self._nodes]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# -----------------------------------------------------------------------------
+# Project Index & Snapshot Cache
+# -----------------------------------------------------------------------------
+class ProjectIndex:
+    """Single-pass index of the files in a project directory.
+
+    The tree is walked at most once per change generation; every caller that
+    needs file lists, image lists, sizes or counts reads the same scan. Call
+    invalidate() whenever files may have changed to start a new generation.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.generation = 0
+        self._scanned_generation = -1
+        self._files = []
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Mark the current scan as stale; the next read walks the tree again."""
+        with self._lock:
+            self.generation += 1
+
+    def scan(self):
+        """Return stat info for every file, walking the tree only if stale."""
+        with self._lock:
+            if self._scanned_generation != self.generation:
+                self._files = self._walk()
+                self._scanned_generation = self.generation
+            return self._files
+
+    def _walk(self):
+        files = []
+        if not self.root.exists():
+            return files
+
+        for root, _, filenames in os.walk(self.root):
+            for name in sorted(filenames):
+                file_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                files.append({
+                    "path": os.path.relpath(file_path, self.root),
+                    "full_path": file_path,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "is_image": name.lower().endswith(IMAGE_EXTENSIONS),
+                })
+        return files
+
+    def text_files(self):
+        """Stat info for every non-image file."""
+        return [info for info in self.scan() if not info["is_image"]]
+
+    def images(self):
+        """Stat info for every image file."""
+        return [info for info in self.scan() if info["is_image"]]
+
+    def has_images(self):
+        return any(info["is_image"] for info in self.scan())
+
+    def counts(self):
+        """File, image and total byte counts for the project."""
+        files = self.scan()
+        image_count = sum(1 for info in files if info["is_image"])
+        return {
+            "files": len(files) - image_count,
+            "images": image_count,
+            "bytes": sum(info["size"] for info in files),
+        }
+
+
+class ImagePreparer:
+    """Downscales and re-encodes project images for prompt payloads.
+
+    Prepared images are cached on disk under CACHE_DIR, keyed by the source
+    file's content hash and the target size, so each screenshot is resized
+    and compressed once rather than uploaded at full resolution every turn.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR / "images", max_edge=IMAGE_MAX_EDGE, quality=80):
+        self.cache_dir = Path(cache_dir)
+        self.max_edge = max_edge
+        self.quality = quality
+        self.format, self.mime_type = ("WEBP", "image/webp") if features.check("webp") else ("JPEG", "image/jpeg")
+
+    def _cache_path(self, source_hash):
+        extension = "webp" if self.format == "WEBP" else "jpg"
+        return self.cache_dir / f"{source_hash}_{self.max_edge}.{extension}"
+
+    def prepare(self, raw, source_hash):
+        """Return a prompt part plus the prepared (width, height) for raw image bytes."""
+        cache_path = self._cache_path(source_hash)
+        try:
+            data = cache_path.read_bytes()
+            with Image.open(io.BytesIO(data)) as img:
+                size = img.size
+        except (OSError, Image.UnidentifiedImageError):
+            data, size = self._encode(raw)
+            try:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                cache_path.write_bytes(data)
+            except OSError:
+                pass  # Caching is best-effort; the prepared bytes are still usable
+
+        return {"inline_data": {"mime_type": self.mime_type, "data": data}}, size
+
+    def _encode(self, raw):
+        with Image.open(io.BytesIO(raw)) as img:
+            img.seek(0)  # First frame of animated images
+            has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            img = img.convert("RGBA" if has_alpha and self.format == "WEBP" else "RGB")
+            img.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+            buffer = io.BytesIO()
+            img.save(buffer, self.format, quality=self.quality)
+            return buffer.getvalue(), img.size
+
+
+class ProjectSnapshotCache:
+    """Keeps prepared project file contents between prompt builds.
+
+    Entries are keyed by relative path and revalidated against the project
+    index by (mtime, size), so a refresh only re-reads files that changed
+    since the previous one. Each entry also records a SHA-256 of the file
+    contents; images are stored as prepared (downscaled) prompt parts.
+    """
+    TEXT_LIMIT = 3000  # Characters of each text file included in prompts
+
+    def __init__(self, index, image_preparer=None):
+        self.index = index
+        self.image_preparer = image_preparer or ImagePreparer()
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Reload changed files and return entries in prompt order."""
+        with self._lock:
+            current = []
+            for info in self.index.scan():
+                rel_path = info["path"]
+                entry = self.entries.get(rel_path)
+                if entry is None or entry["mtime"] != info["mtime"] or entry["size"] != info["size"]:
+                    entry = self._load_entry(info)
+                    if entry is None:
+                        self.entries.pop(rel_path, None)
+                        continue
+                    self.entries[rel_path] = entry
+                current.append(rel_path)
+
+            # Forget files that no longer exist
+            for rel_path in set(self.entries) - set(current):
+                del self.entries[rel_path]
+
+            return [self.entries[rel_path] for rel_path in current]
+
+    def _load_entry(self, info):
+        """Read one file and build its cache entry, or None if it cannot be read."""
+        try:
+            with open(info["full_path"], "rb") as f:
+                raw = f.read()
+        except IOError:
+            return None
+
+        entry = {
+            "path": info["path"],
+            "mtime": info["mtime"],
+            "size": info["size"],
+            "hash": hashlib.sha256(raw).hexdigest(),
+            "is_image": info["is_image"],
+        }
+        if entry["is_image"]:
+            try:
+                entry["image"], entry["image_size"] = self.image_preparer.prepare(raw, entry["hash"])
+            except Exception:
+                entry["image"], entry["image_size"] = None, None
+        else:
+            text = raw.decode("utf-8", errors="ignore").replace("\r\n", "\n")
+            entry["text"] = text[:self.TEXT_LIMIT]
+        return entry
+
+# -----------------------------------------------------------------------------
+# Response Cache
+# -----------------------------------------------------------------------------
+class ResponseCache:
+    """On-disk cache of model responses with TTL expiry and LRU eviction.
+
+    Keys combine the model name, request config and a hash of the normalized
+    contents. Entries are JSON files whose mtime is bumped on every hit, so
+    eviction removes the least recently used files once the cache grows past
+    max_bytes.
+    """
+    STALE_TEMP_SECONDS = 3600  # Age after which a leftover *.tmp write is removed
+
+    def __init__(self, cache_dir=CACHE_DIR / "responses", max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl_seconds=RESPONSE_CACHE_TTL):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _normalize(cls, value):
+        """Reduce request contents to a stable, JSON-serializable form for hashing."""
+        if isinstance(value, str):
+            return value.replace("\r\n", "\n").strip()
+        if isinstance(value, bytes):
+            return {"bytes_sha256": hashlib.sha256(value).hexdigest()}
+        if isinstance(value, dict):
+            return {key: cls._normalize(item) for key, item in sorted(value.items()) if item is not None}
+        if isinstance(value, (list, tuple)):
+            return [cls._normalize(item) for item in value]
+        if isinstance(value, Image.Image):
+            return {"image_sha256": hashlib.sha256(value.tobytes()).hexdigest(), "size": value.size}
+        if hasattr(value, "model_dump"):
+            return cls._normalize(value.model_dump(exclude_none=True))
+        return value
+
+    def make_key(self, model, contents, config=None):
+        payload = json.dumps(
+            {"model": model, "contents": self._normalize(contents), "config": self._normalize(config)},
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key):
+        """Return the cached response for key, or None on a miss or expired entry."""
+        path = self._entry_path(key)
+        with self._lock:
+            try:
+                entry = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+
+            if time.time() - entry.get("created", 0) > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                self.misses += 1
+                return None
+
+            try:
+                os.utime(path)  # Mark as most recently used
+            except OSError:
+                pass  # Evicted by another process meanwhile
+            self.hits += 1
+        return types.GenerateContentResponse.model_validate(entry["response"])
+
+    def put(self, key, response):
+        """Store a response and evict the least recently used entries if over budget."""
+        entry = {
+            "created": time.time(),
+            "response": json.loads(response.model_dump_json(exclude_none=True)),
+        }
+        # Write then rename, so other processes sharing the cache never read a partial entry
+        path = self._entry_path(key)
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with self._lock:
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                temp_path.write_text(json.dumps(entry), encoding="utf-8")
+                os.replace(temp_path, path)
+            except OSError:
+                try:
+                    temp_path.unlink(missing_ok=True)
+                except OSError:
+                    pass
+                return
+            self._evict()
+
+    def _evict(self):
+        # Temp files left by a process that died mid-write; live writes take far less than this
+        for path in self.cache_dir.glob("*.tmp"):
+            try:
+                if time.time() - path.stat().st_mtime > self.STALE_TEMP_SECONDS:
+                    path.unlink()
+            except OSError:
+                continue
+
+        files = []
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files, key=lambda item: item[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for path in self.cache_dir.glob("*.json"):
+                path.unlink(missing_ok=True)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "hit_rate": hit_rate}
+
+# -----------------------------------------------------------------------------
+# Context Caching
+# -----------------------------------------------------------------------------
+class ContextCacheRegistry:
+    """Server-side cached-content handles for stable prompt prefixes.
+
+    A prefix (an agent system prompt plus the project snapshot) is registered
+    with client.aio.caches once, and later calls send only the rest of the
+    prompt and reference the cache by name. Each slot (one per project and
+    role) holds a single cache: when its prefix changes, e.g. because a file
+    was edited, the old cache is deleted. Creating a cache costs a round trip
+    and the full prefix, so a new prefix is only cached the second time a
+    slot sees it, or on first sight if expect_reuse() announced it. Prefixes
+    below min_tokens are not cached, as the API rejects them. A prefix the API
+    refuses outright is not offered again; after a transient failure (quota,
+    timeout, server error) the next call tries again.
+    """
+    REFRESH_MARGIN = 60  # Seconds before expiry at which a cache is recreated instead of reused
+    PERMANENT_ERROR_CODES = (400, 403, 404)  # Prefix refused, or a model without caching support
+
+    def __init__(self, client, min_tokens=CONTEXT_CACHE_MIN_TOKENS, ttl_seconds=CONTEXT_CACHE_TTL):
+        self.client = client
+        self.min_tokens = min_tokens
+        self.ttl_seconds = ttl_seconds
+        self.slots = {}  # Slot -> {"digest", "name", "expires", "tokens"}
+        self.created = 0
+        self.reused = 0
+        self.deferred = 0
+        self.failures = 0
+        self._failed_digests = set()
+        self._expected_digests = set()
+        self._last_seen = {}  # Slot -> digest of the last prefix sent inline
+        self._locks = {}
+
+    def digest(self, model, prefix):
+        payload = json.dumps({"model": model, "prefix": ResponseCache._normalize(prefix)}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def resolve(self, slot, model, prefix, tokens):
+        """Cache name holding prefix, created or refreshed as needed; None if it cannot be cached."""
+        if tokens < self.min_tokens:
+            return None
+        digest = await asyncio.to_thread(self.digest, model, prefix)
+        async with self._locks.setdefault(slot, asyncio.Lock()):
+            entry = self.slots.get(slot)
+            if entry and entry["digest"] == digest and entry["expires"] - time.time() > self.REFRESH_MARGIN:
+                self.reused += 1
+                return entry["name"]
+
+            if entry:
+                await self.forget(slot)
+            if digest in self._failed_digests:
+                return None
+            if self._last_seen.get(slot) != digest and digest not in self._expected_digests:
+                self._last_seen[slot] = digest  # Used once so far: cache it if it comes back
+                self.deferred += 1
+                return None
+            try:
+                cache = await self.client.aio.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        contents=[{"role": "user", "parts": prefix}],
+                        ttl=f"{self.ttl_seconds}s",
+                        display_name=f"{APP_TITLE} {slot}"[:128],
+                    ),
+                )
+            except Exception as error:
+                # Send the prefix inline instead; only a refusal is final
+                self.failures += 1
+                if self._is_permanent(error):
+                    self._failed_digests.add(digest)
+                return None
+            self.slots[slot] = {
+                "digest": digest, "name": cache.name, "tokens": tokens,
+                "expires": time.time() + self.ttl_seconds,
+            }
+            self._last_seen.pop(slot, None)
+            self._expected_digests.discard(digest)
+            self.created += 1
+            return cache.name
+
+    def expect_reuse(self, digest):
+        """Cache the prefix with this digest the first time it is resolved."""
+        self._expected_digests.add(digest)
+
+    @classmethod
+    def _is_permanent(cls, error):
+        return getattr(error, "code", None) in cls.PERMANENT_ERROR_CODES
+
+    def holds(self, slot, digest):
+        """Whether slot has a live cache for the prefix with this digest."""
+        entry = self.slots.get(slot)
+        return bool(entry) and entry["digest"] == digest and entry["expires"] - time.time() > self.REFRESH_MARGIN
+
+    async def forget(self, slot):
+        """Drop a slot's cache, e.g. after the server reported it missing."""
+        entry = self.slots.pop(slot, None)
+        if entry:
+            try:
+                await self.client.aio.caches.delete(name=entry["name"])
+            except Exception:
+                pass  # Already expired or deleted
+
+    def stats(self):
+        return {
+            "active": len(self.slots),
+            "created": self.created,
+            "reused": self.reused,
+            "deferred": self.deferred,
+            "failures": self.failures,
+            "cached_tokens": sum(entry["tokens"] for entry in self.slots.values()),
+        }
+
+# -----------------------------------------------------------------------------
+# Context Packing
+# -----------------------------------------------------------------------------
+class ContextPacker:
+    """Selects which context parts fit in a prompt's token budget.
+
+    Candidates are ranked by relevance to the current request (file names and
+    keywords mentioned, recent changes, errors and history) and added until the
+    budget is spent. Selected parts keep their original order in the prompt.
+    """
+    CHARS_PER_TOKEN = 4
+    IMAGE_TILE_TOKENS = 258  # Gemini charges per 768x768 image tile
+    IMAGE_TILE_SIZE = 768
+    STOPWORDS = {
+        "the", "and", "for", "with", "that", "this", "from", "into", "please",
+        "make", "create", "file", "files", "code", "should", "would", "using",
+    }
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET):
+        self.token_budget = token_budget
+
+    @classmethod
+    def estimate_text_tokens(cls, text):
+        return math.ceil(len(text) / cls.CHARS_PER_TOKEN)
+
+    @classmethod
+    def estimate_image_tokens(cls, size):
+        width, height = size
+        tiles = math.ceil(width / cls.IMAGE_TILE_SIZE) * math.ceil(height / cls.IMAGE_TILE_SIZE)
+        return max(1, tiles) * cls.IMAGE_TILE_TOKENS
+
+    def _keywords(self, text):
+        words = re.findall(r"[a-zA-Z_][a-zA-Z0-9_]{2,}", text.lower())
+        return {word for word in words if word not in self.STOPWORDS}
+
+    def score(self, candidate, query, keywords, recent_paths):
+        """Relevance of one candidate to the current request."""
+        if candidate["kind"] == "errors":
+            return 1000
+        if candidate["kind"] in ("history", "manifest"):
+            return 500
+
+        path = candidate["label"]
+        path_lower = path.lower()
+        score = 0.0
+        if path_lower in query or os.path.basename(path_lower) in query:
+            score += 200  # Explicitly mentioned by the user
+        if path in recent_paths:
+            score += 100
+        score += 20 * sum(1 for word in keywords if word in path_lower)
+        body = candidate.get("text", "").lower()
+        if body:
+            score += min(50, sum(body.count(word) for word in keywords))
+        if candidate["kind"] == "image" and keywords & {"image", "images", "visual", "design", "screenshot", "icon", "logo", "art"}:
+            score += 50
+        return score
+
+    def pack(self, candidates, query, reserved_tokens=0, recent_paths=()):
+        """Return (selected candidates in original order, report dict)."""
+        query = query.lower()
+        keywords = self._keywords(query)
+        recent_paths = set(recent_paths)
+        ranked = sorted(
+            enumerate(candidates),
+            key=lambda item: (-self.score(item[1], query, keywords, recent_paths), item[0])
+        )
+
+        used = reserved_tokens
+        selected, dropped = [], []
+        for index, candidate in ranked:
+            if used + candidate["tokens"] <= self.token_budget:
+                selected.append((index, candidate))
+                used += candidate["tokens"]
+            else:
+                dropped.append(candidate)
+
+        selected.sort(key=lambda item: item[0])
+        report = {
+            "budget": self.token_budget,
+            "used": used,
+            "included": len(selected),
+            "total": len(candidates),
+            "dropped": [candidate["label"] for candidate in dropped],
+            "dropped_tokens": sum(candidate["tokens"] for candidate in dropped),
+        }
+        return [candidate for _, candidate in selected], report
+
+# -----------------------------------------------------------------------------
+# Tracing
+# -----------------------------------------------------------------------------
+class Tracer:
+    """Collects timed spans for the phases of an interaction.
+
+    Each span records its start and end, the lane it ran on (the asyncio task,
+    or the thread outside the event loop), its parent span and free-form
+    attributes (bytes and parts sent, response length, ...). The open-span
+    stack lives in a context variable, so tasks and worker threads started
+    inside a span are parented to it. Spans can be exported as JSONL or as a
+    Chrome trace-event file that opens in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.trace_start = time.time()
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._stack = contextvars.ContextVar(f"trace_stack_{id(self)}", default=())
+
+    def reset(self):
+        """Drop recorded spans and start a new trace."""
+        with self._lock:
+            self.spans = []
+            self.trace_start = time.time()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the enclosed block; yields the span so callers can add attributes."""
+        stack = self._stack.get()
+        with self._lock:
+            span_id = self._next_id
+            self._next_id += 1
+
+        span = {
+            "id": span_id,
+            "parent": stack[-1]["id"] if stack else None,
+            "name": name,
+            "thread": self._current_lane(),
+            "start": time.time(),
+            "attributes": dict(attributes),
+        }
+        started = time.perf_counter()
+        self._stack.set(stack + (span,))
+        try:
+            yield span
+        except Exception as e:
+            span["attributes"]["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self._stack.set(stack)
+            span["duration"] = time.perf_counter() - started
+            span["end"] = span["start"] + span["duration"]
+            with self._lock:
+                self.spans.append(span)
+
+    @staticmethod
+    def _current_lane():
+        """Name of the running asyncio task, or of the thread outside the event loop."""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return task.get_name() if task else threading.current_thread().name
+
+    def sorted_spans(self):
+        with self._lock:
+            return sorted(self.spans, key=lambda span: span["start"])
+
+    def export_jsonl(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for span in self.sorted_spans():
+                f.write(json.dumps(span, default=str) + "\n")
+
+    def export_chrome_trace(self, path):
+        spans = self.sorted_spans()
+        # Chrome traces need numeric thread ids; lanes are named with metadata events
+        lane_ids = {}
+        for span in spans:
+            lane_ids.setdefault(span["thread"], len(lane_ids) + 1)
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": lane_id, "args": {"name": lane}}
+            for lane, lane_id in lane_ids.items()
+        ]
+        events.extend(
+            {
+                "name": span["name"],
+                "cat": "agents",
+                "ph": "X",
+                "ts": (span["start"] - self.trace_start) * 1_000_000,
+                "dur": span["duration"] * 1_000_000,
+                "pid": os.getpid(),
+                "tid": lane_ids[span["thread"]],
+                "args": span["attributes"],
+            }
+            for span in spans
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+    def format_spans(self):
+        """Human-readable span listing, indented by nesting depth."""
+        spans = self.sorted_spans()
+        depth = {}
+        lines = []
+        for span in spans:
+            depth[span["id"]] = depth.get(span["parent"], -1) + 1
+            offset = span["start"] - self.trace_start
+            details = "  ".join(f"{key}={value}" for key, value in span["attributes"].items())
+            indent = "  " * depth[span["id"]]
+            lines.append(f"+{offset:7.3f}s {span['duration']:8.3f}s  {indent}{span['name']}  {details}".rstrip())
+        return lines
+
+
+# -----------------------------------------------------------------------------
+# Usage Accounting
+# -----------------------------------------------------------------------------
+class UsageLedger:
+    """Per-session record of token usage and latency for every model call.
+
+    Entries are tagged with the agent role that made the call, so totals can
+    be broken down by phase and compared against per-minute quotas.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.session_start = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, role, model, usage_metadata, latency, response_cache_hit=False):
+        """Add one call; usage_metadata is the response's usage_metadata (may be None)."""
+        entry = {
+            "role": role,
+            "model": model,
+            "input_tokens": getattr(usage_metadata, "prompt_token_count", None) or 0,
+            "output_tokens": getattr(usage_metadata, "candidates_token_count", None) or 0,
+            "thinking_tokens": getattr(usage_metadata, "thoughts_token_count", None) or 0,
+            "cached_tokens": getattr(usage_metadata, "cached_content_token_count", None) or 0,
+            "latency": latency,
+            "response_cache_hit": response_cache_hit,
+            "timestamp": time.time(),
+        }
+        with self._lock:
+            self.entries.append(entry)
+        return entry
+
+    def by_role(self, since=0):
+        """Aggregate calls, tokens and latency per agent role, from entry index since onwards."""
+        totals = {}
+        with self._lock:
+            entries = self.entries[since:]
+        for entry in entries:
+            role_totals = totals.setdefault(entry["role"], {
+                "calls": 0, "input_tokens": 0, "output_tokens": 0, "thinking_tokens": 0,
+                "cached_tokens": 0, "latency": 0.0, "response_cache_hits": 0,
+            })
+            role_totals["calls"] += 1
+            role_totals["latency"] += entry["latency"]
+            role_totals["response_cache_hits"] += int(entry["response_cache_hit"])
+            for key in ("input_tokens", "output_tokens", "thinking_tokens", "cached_tokens"):
+                role_totals[key] += entry[key]
+        return totals
+
+    def totals(self, since=0):
+        combined = {"calls": 0, "input_tokens": 0, "output_tokens": 0, "thinking_tokens": 0, "cached_tokens": 0}
+        for role_totals in self.by_role(since).values():
+            for key in combined:
+                combined[key] += role_totals[key]
+        return combined
+
+    def throughput(self, window_seconds=60):
+        """Requests and tokens in the last window, plus the session average per minute."""
+        now = time.time()
+        with self._lock:
+            recent = [entry for entry in self.entries if now - entry["timestamp"] <= window_seconds]
+            all_tokens = sum(entry["input_tokens"] + entry["output_tokens"] for entry in self.entries)
+        session_minutes = max((now - self.session_start) / 60, 1 / 60)
+        return {
+            "requests_last_minute": len(recent),
+            "tokens_last_minute": sum(entry["input_tokens"] + entry["output_tokens"] for entry in recent),
+            "tokens_per_minute": all_tokens / session_minutes,
+        }
+
+    def format_report(self):
+        """Text report for the project statistics dialog."""
+        lines = []
+        for role, role_totals in sorted(self.by_role().items()):
+            avg_latency = role_totals["latency"] / role_totals["calls"]
+            lines.append(
+                f"  • {AGENT_ROLES.get(role, role)}: {role_totals['calls']} calls, "
+                f"{role_totals['input_tokens']:,} in / {role_totals['output_tokens']:,} out, "
+                f"{role_totals['cached_tokens']:,} cached, avg {avg_latency:.2f}s"
+            )
+        totals = self.totals()
+        rate = self.throughput()
+        lines.append(
+            f"  Σ {totals['calls']} calls, {totals['input_tokens']:,} in / {totals['output_tokens']:,} out "
+            f"({totals['thinking_tokens']:,} thinking), {totals['cached_tokens']:,} cached"
+        )
+        if totals["cached_tokens"]:
+            share = totals["cached_tokens"] / totals["input_tokens"] * 100 if totals["input_tokens"] else 0.0
+            lines.append(
+                f"  🧊 Context cache: {totals['cached_tokens']:,} of {totals['input_tokens']:,} input tokens "
+                f"served from cached prefixes ({share:.0f}%)"
+            )
+        lines.append(
+            f"  ⏱️ Last minute: {rate['requests_last_minute']} requests, {rate['tokens_last_minute']:,} tokens "
+            f"(session avg {rate['tokens_per_minute']:,.0f} tokens/min)"
+        )
+        return lines
+
+
+# -----------------------------------------------------------------------------
+# Retry Policy
+# -----------------------------------------------------------------------------
+class RetryPolicy:
+    """Decides after each graded attempt whether another Main Coder attempt is worthwhile.
+
+    Retries stop when the grade passes, when the attempt limit is reached,
+    when the last retry improved the grade by less than min_improvement
+    points, or when the interaction has used up its time or token budget
+    (None disables a budget).
+    """
+
+    def __init__(self, max_attempts=3, pass_grade=70, min_improvement=5, max_seconds=None, max_tokens=None):
+        self.max_attempts = max_attempts
+        self.pass_grade = pass_grade
+        self.min_improvement = min_improvement
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+
+    def decide(self, grades, elapsed, tokens_used):
+        """Return a decision dict for the grade trajectory so far (one grade per attempt)."""
+        attempt = len(grades)
+        grade = grades[-1]
+        improvement = grade - grades[-2] if attempt > 1 else None
+
+        if grade >= self.pass_grade:
+            retry, reason = False, "passed"
+        elif attempt >= self.max_attempts:
+            retry, reason = False, "max_attempts"
+        elif improvement is not None and improvement < self.min_improvement:
+            retry, reason = False, "plateau"
+        elif self.max_seconds is not None and elapsed >= self.max_seconds:
+            retry, reason = False, "time_budget"
+        elif self.max_tokens is not None and tokens_used >= self.max_tokens:
+            retry, reason = False, "token_budget"
+        else:
+            retry, reason = True, "below_pass_grade"
+
+        return {
+            "retry": retry,
+            "reason": reason,
+            "attempt": attempt,
+            "grades": list(grades),
+            "improvement": improvement,
+            "elapsed": round(elapsed, 2),
+            "tokens_used": tokens_used,
+        }
+
+    def describe(self, decision):
+        """Chat message explaining a decision."""
+        grade = decision["grades"][-1]
+        reason = decision["reason"]
+        if reason == "passed":
+            return f"✅ Grade acceptable ({grade}/100). Implementation approved!"
+        if reason == "below_pass_grade":
+            return (f"⚠️ Grade below {self.pass_grade}. Requesting Main Coder to improve... "
+                    f"(Attempt {decision['attempt'] + 1}/{self.max_attempts})")
+        if reason == "max_attempts":
+            return f"⚠️ Maximum attempts reached. Final grade: {grade}/100"
+        if reason == "plateau":
+            return (f"⏹️ Grade plateaued ({decision['grades'][-2]} → {grade}, "
+                    f"less than +{self.min_improvement}). Stopping retries. Final grade: {grade}/100")
+        if reason == "time_budget":
+            return f"⏹️ Time budget spent ({decision['elapsed']:.0f}s of {self.max_seconds}s). Final grade: {grade}/100"
+        return f"⏹️ Token budget spent ({decision['tokens_used']:,} of {self.max_tokens:,}). Final grade: {grade}/100"
+
+
+# -----------------------------------------------------------------------------
+# Async Runtime
+# -----------------------------------------------------------------------------
+class AsyncRunner:
+    """Background event loop shared by every agent engine in the process.
+
+    The interaction pipeline is written with asyncio; synchronous callers such
+    as the Tk worker threads submit coroutines and async generators here, so
+    any number of interactions can overlap on one loop.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """The runner's event loop, started on a daemon thread on first use."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="agent-event-loop", daemon=True).start()
+            return self._loop
+
+    def run(self, coro):
+        """Run a coroutine on the loop and block until it finishes."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def iterate(self, agen):
+        """Drive an async generator on the loop and yield its items synchronously.
+
+        The generator runs as a single task, so it keeps one context for its
+        whole lifetime. Closing the returned generator early cancels the task.
+        """
+        items = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put(("item", item))
+            except Exception as e:
+                items.put(("error", e))
+            else:
+                items.put(("end", None))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                kind, payload = items.get()
+                if kind == "error":
+                    raise payload
+                if kind == "end":
+                    return
+                yield payload
+        finally:
+            future.cancel()  # No-op once the pipeline has finished
+
+
+class RateLimiter:
+    """Caps concurrent requests and requests per minute to one model.
+
+    Shared by every session of an engine and used as `async with limiter:`
+    on the engine's event loop. Waiters are admitted in arrival order and
+    sleep on a condition until a slot frees up; only the waiter at the head
+    of the queue wakes on its own, when the per-minute budget allows another
+    request. Limit changes take effect at the next admission.
+    """
+
+    def __init__(self, max_concurrent=4, requests_per_minute=None):
+        self.max_concurrent = max_concurrent
+        self.requests_per_minute = requests_per_minute
+        self.active = 0
+        self._starts = deque()  # Start times within the last minute
+        self._waiters = deque()
+        self._condition = None  # Created on first use, on the loop that uses it
+
+    def _rate_delay(self):
+        """Seconds until another request fits in the per-minute budget."""
+        now = time.monotonic()
+        while self._starts and now - self._starts[0] >= 60:
+            self._starts.popleft()
+        if self.requests_per_minute and len(self._starts) >= self.requests_per_minute:
+            return self._starts[0] + 60 - now
+        return 0
+
+    async def __aenter__(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        waiter = object()
+        async with self._condition:
+            self._waiters.append(waiter)
+            try:
+                while True:
+                    if self._waiters[0] is waiter and self.active < max(1, self.max_concurrent):
+                        delay = self._rate_delay()
+                        if delay <= 0:
+                            break
+                        try:
+                            await asyncio.wait_for(self._condition.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await self._condition.wait()
+            finally:
+                self._waiters.remove(waiter)
+                self._condition.notify_all()  # The next waiter may now be at the head
+            self.active += 1
+            self._starts.append(time.monotonic())
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        self._rate_delay()  # Drop starts older than a minute
+        return {"active": self.active, "waiting": len(self._waiters), "last_minute": len(self._starts)}
+
+
+async_runner = AsyncRunner()
+
+
+# -----------------------------------------------------------------------------
+# Agent Sessions
+# -----------------------------------------------------------------------------
+# Session of the interaction running in the current task or worker thread
+current_session = contextvars.ContextVar("current_session", default=None)
+
+
+class AgentSession:
+    """Mutable state of one conversation on one project directory.
+
+    An engine can serve many sessions at once; the shared parts (model
+    client, response cache, settings) stay on the engine. A session runs one
+    interaction at a time.
+    """
+
+    def __init__(self, project_dir=None):
+        self.project_dir = Path(project_dir) if project_dir is not None else VM_DIR
+        self.conversation_history = []
+        self.error_context = []
+        self.project_context = {"files": [], "images": [], "recent_changes": []}
+        self.current_attempt = 0
+        self.project_index = ProjectIndex(self.project_dir)
+        self.snapshot_cache = ProjectSnapshotCache(self.project_index)
+        self.last_context_report = None
+        self.context_base = None  # Project snapshot in the Main Coder's cached prefix, for delta context
+        self.context_cache_slot = str(self.project_dir)  # Server-side prefix caches are kept per slot
+        self.tracer = Tracer()
+        self.usage_ledger = UsageLedger()
+        self.active = False
+        self.task = None  # asyncio task driving the running interaction
+        self.cancel_requested = False
+
+
+class SessionAttribute:
+    """Engine attribute stored on the session of the running interaction."""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, engine, owner=None):
+        if engine is None:
+            return self
+        return getattr(engine.session, self.name)
+
+    def __set__(self, engine, value):
+        setattr(engine.session, self.name, value)
+
+
 # -----------------------------------------------------------------------------
 # Enhanced Multi-Agent System
 # -----------------------------------------------------------------------------
 class EnhancedMultiAgentSystem:
-    def __init__(self, api_key):
+    # Per-interaction state lives on the active AgentSession
+    conversation_history = SessionAttribute()
+    error_context = SessionAttribute()
+    project_context = SessionAttribute()
+    current_attempt = SessionAttribute()
+    project_index = SessionAttribute()
+    snapshot_cache = SessionAttribute()
+    last_context_report = SessionAttribute()
+    context_base = SessionAttribute()
+    tracer = SessionAttribute()
+    usage_ledger = SessionAttribute()
+
+    def __init__(self, api_key, backend=BACKEND, backend_options=None):
         if not GENAI_IMPORTED:
             raise ImportError("google-genai not installed")
 
-        self.client = genai.Client(api_key=api_key)
-        self.conversation_history = []
-        self.error_context = []
-        self.project_context = {"files": [], "images": [], "recent_changes": []}
+        self.client = create_client(api_key, backend, backend_options)
+        self.default_session = AgentSession(VM_DIR)
+        self.context_packer = ContextPacker()
+        self.response_cache = ResponseCache()
+        self.context_cache = ContextCacheRegistry(self.client)
+        self.context_caching_enabled = True
+        self.response_cache_roles = {"prompt_enhancer"}
         self.grading_enabled = True
         self.prompt_enhancer_enabled = True
-        self.max_retry_attempts = 3
-        self.current_attempt = 0
+        self.streaming_enabled = True
+        self.execute_while_streaming = True
+        self.retry_policy = RetryPolicy()
+        self.command_workers = 4  # Independent agent commands run at once
+        self.image_limiter = RateLimiter(IMAGE_CONCURRENCY, IMAGE_REQUESTS_PER_MINUTE)
+        self.candidate_count = 1  # Above 1, best-of-N candidates replace sequential retries
+        self.combined_critique_enabled = True
+        self.delta_context_enabled = False
+        self.delta_context_rebase_ratio = DELTA_CONTEXT_REBASE_RATIO
         
         self.command_handlers = {
             "create_file": self._create_file,
@@ -217,14 +1720,11 @@ class EnhancedMultiAgentSystem:
             "generate_image": self.generate_image,
         }
 
-    def _get_enhanced_prompt(self, user_prompt):
+    async def _get_enhanced_prompt(self, user_prompt):
         """Calls the PROMPT_ENHANCER_AGENT to refine the user's prompt."""
         try:
             prompt_parts = [{"text": f"{PROMPT_ENHANCER_AGENT_PROMPT}\n\n{user_prompt}"}]
-            enhanced_response = self.client.models.generate_content(
-                model=TEXT_MODEL_NAME,
-                contents=prompt_parts
-            )
+            enhanced_response = await self._generate_content("prompt_enhancer", prompt_parts)
             self._log_interaction("prompt_enhancer", enhanced_response.text)
             return enhanced_response.text
         except Exception as e:
@@ -232,98 +1732,229 @@ class EnhancedMultiAgentSystem:
             # Fallback to original prompt if enhancer fails
             return user_prompt
 
-    def run_enhanced_interaction(self, original_user_prompt):
+    @property
+    def max_retry_attempts(self):
+        return self.retry_policy.max_attempts
+
+    @max_retry_attempts.setter
+    def max_retry_attempts(self, value):
+        self.retry_policy.max_attempts = value
+
+    @property
+    def max_retry_seconds(self):
+        return self.retry_policy.max_seconds
+
+    @max_retry_seconds.setter
+    def max_retry_seconds(self, value):
+        self.retry_policy.max_seconds = value
+
+    @property
+    def max_retry_tokens(self):
+        return self.retry_policy.max_tokens
+
+    @max_retry_tokens.setter
+    def max_retry_tokens(self, value):
+        self.retry_policy.max_tokens = value
+
+    @property
+    def image_concurrency(self):
+        return self.image_limiter.max_concurrent
+
+    @image_concurrency.setter
+    def image_concurrency(self, value):
+        self.image_limiter.max_concurrent = value
+
+    @property
+    def image_requests_per_minute(self):
+        return self.image_limiter.requests_per_minute
+
+    @image_requests_per_minute.setter
+    def image_requests_per_minute(self, value):
+        self.image_limiter.requests_per_minute = value
+
+    @property
+    def session(self):
+        """Session of the running interaction, or the default session outside one."""
+        return current_session.get() or self.default_session
+
+    def create_session(self, project_dir=None):
+        """New independent session, e.g. for another project directory."""
+        return AgentSession(project_dir)
+
+    def run_enhanced_interaction(self, original_user_prompt, session=None):
+        """Synchronous adapter over run_interaction_async for threaded callers such as the Tk UI."""
+        yield from async_runner.iterate(self.run_interaction_async(original_user_prompt, session))
+
+    async def run_interaction_async(self, original_user_prompt, session=None):
+        """Run one interaction in a session (the default session when omitted).
+
+        The session is bound to the context of the task driving this
+        generator, so each concurrent interaction needs its own task.
+        """
+        session = session or self.default_session
+        if session.active:
+            yield {"type": "error", "content": "⏳ This session is already running an interaction."}
+            return
+
+        previous_session = current_session.get()
+        current_session.set(session)
+        session.active = True
+        session.task = asyncio.current_task()
+        session.cancel_requested = False
+        try:
+            async for event in self._run_pipeline(original_user_prompt):
+                yield event
+        except asyncio.CancelledError:
+            if not session.cancel_requested:
+                raise
+            if hasattr(session.task, "uncancel"):  # Python 3.11+; earlier versions keep no cancel count
+                session.task.uncancel()
+            yield {"type": "cancelled", "content": "⏹️ Interaction cancelled."}
+        finally:
+            session.active = False
+            session.task = None
+            current_session.set(previous_session)
+
+    def cancel_interaction(self, session=None):
+        """Abort a session's running interaction at its next await; safe to call from any thread.
+
+        In-flight model calls are abandoned and commands that have not started
+        yet are skipped. Returns False when nothing is running.
+        """
+        session = session or self.default_session
+        task = session.task
+        if task is None or task.done():
+            return False
+        session.cancel_requested = True
+        task.get_loop().call_soon_threadsafe(task.cancel)
+        return True
+
+    async def _run_pipeline(self, original_user_prompt):
         """Enhanced multi-agent interaction with grading and retry system"""
         if not self.client:
             yield {"type": "error", "content": "AI system not configured. Please set API key."}
             return
 
-        if self.prompt_enhancer_enabled:
-            # Initial prompt enhancement (occurs only once before retries)
-            yield {"type": "system", "content": "✨ Enhancing prompt..."}
-            enhanced_user_prompt = self._get_enhanced_prompt(original_user_prompt)
-            yield {"type": "agent", "agent": "✨ Prompt Enhancer", "content": enhanced_user_prompt}
-        else:
-            enhanced_user_prompt = original_user_prompt
-            yield {"type": "system", "content": "✨ Prompt enhancer disabled. Using original prompt."}
+        self.tracer.reset()
+        started = time.perf_counter()
+        usage_mark = len(self.usage_ledger.entries)
+
+        # Files may have been edited outside the IDE since the last turn. The
+        # scan does not depend on the enhanced prompt, so it runs while the
+        # enhancer request is in flight.
+        self.project_index.invalidate()
+        preflight = asyncio.create_task(asyncio.to_thread(self._preflight_context), name="context_preflight")
+        try:
+            if self.prompt_enhancer_enabled:
+                # Initial prompt enhancement (occurs only once before retries)
+                yield {"type": "system", "content": "✨ Enhancing prompt..."}
+                with self.tracer.span("prompt_enhancement"):
+                    enhanced_user_prompt = await self._get_enhanced_prompt(original_user_prompt)
+                yield {"type": "agent", "agent": "✨ Prompt Enhancer", "content": enhanced_user_prompt}
+            else:
+                enhanced_user_prompt = original_user_prompt
+                yield {"type": "system", "content": "✨ Prompt enhancer disabled. Using original prompt."}
+
+            try:
+                await preflight
+            except Exception:
+                pass  # The context build below reads whatever the preflight could not
+        finally:
+            preflight.cancel()  # No-op once joined
 
         current_main_coder_prompt = enhanced_user_prompt
 
-        # Reset attempt counter for new interactions
+        # Reset attempt counter and grade trajectory for new interactions
         self.current_attempt = 0
-        
+        grade_history = []
+
+        if self.candidate_count > 1 and self.grading_enabled:
+            async for event in self._run_best_of_n(original_user_prompt, enhanced_user_prompt):
+                yield event
+            return
+
         while self.current_attempt < self.max_retry_attempts:
             self.current_attempt += 1
             attempt_suffix = f" (Attempt {self.current_attempt}/{self.max_retry_attempts})" if self.current_attempt > 1 else ""
-            
-            # Update project context
-            self._update_project_context()
-            
+
             # Phase 1: Main Coder Agent Analysis and Implementation
             yield {"type": "system", "content": f"🚀 Main Coder Agent analyzing and implementing...{attempt_suffix}"}
-            
-            main_prompt_parts = self._build_enhanced_prompt(current_main_coder_prompt, MAIN_AGENT_PROMPT)
-            
+
+            with self.tracer.span("context_build", attempt=self.current_attempt) as span:
+                main_prompt_parts = await asyncio.to_thread(self._build_main_prompt, current_main_coder_prompt)
+                span["attributes"]["parts"], span["attributes"]["bytes"] = self._measure_contents(main_prompt_parts)
+            if self.last_context_report["dropped"] or "delta" in self.last_context_report:
+                yield {"type": "system", "content": self._format_context_report(self.last_context_report)}
+
             try:
-                main_response = self.client.models.generate_content(
-                    model=TEXT_MODEL_NAME,
-                    contents=main_prompt_parts
-                )
-                
-                self._log_interaction("user", current_main_coder_prompt) # Log the prompt sent to main coder
-                self._log_interaction("main_coder", main_response.text)
-                
-                yield {"type": "agent", "agent": "🤖 Main Coder", "content": main_response.text}
-                
-                # Execute commands and track changes
                 implementation_results = []
-                for result in self._process_enhanced_commands(main_response.text):
-                    implementation_results.append(result)
-                    yield result
+                execute_live = self.streaming_enabled and self.execute_while_streaming
+                with self.tracer.span("main_call", attempt=self.current_attempt):
+                    if self.streaming_enabled:
+                        async for event in self._stream_agent_response(
+                            "🤖 Main Coder", main_prompt_parts,
+                            implementation_results if execute_live else None,
+                            prefix_parts=self.last_context_report["prefix_parts"]
+                        ):
+                            if event["type"] == "agent_stream_end":
+                                main_text = event["content"]
+                            yield event
+                    else:
+                        main_response = await self._generate_content(
+                            "main_coder", main_prompt_parts, prefix_parts=self.last_context_report["prefix_parts"]
+                        )
+                        main_text = main_response.text
+
+                self._log_interaction("user", current_main_coder_prompt) # Log the prompt sent to main coder
+                self._log_interaction("main_coder", main_text)
+
+                if not self.streaming_enabled:
+                    yield {"type": "agent", "agent": "🤖 Main Coder", "content": main_text}
+
+                # Execute commands and track changes (already done live when streaming)
+                if not execute_live:
+                    async for result in self._process_enhanced_commands(main_text):
+                        implementation_results.append(result)
+                        yield result
 
                 # Phase 2: Smart Agent Selection with Grading
                 # Critics should see the original prompt to understand the user's raw request
-                should_use_critic = self._should_invoke_code_critic(original_user_prompt, main_response.text, implementation_results)
-                should_use_art_critic = self._should_invoke_art_critic(original_user_prompt, main_response.text, implementation_results)
-                
-                critic_grade = None
-                art_grade = None
-                
-                if should_use_critic and self.grading_enabled:
-                    yield {"type": "system", "content": "🔍 Code Critic Agent performing deep analysis and grading..."}
-                    
-                    critic_analysis = self._get_code_critique(original_user_prompt, main_response.text, implementation_results)
-                    if critic_analysis:
-                        yield {"type": "agent", "agent": "📊 Code Critic", "content": critic_analysis}
-                        critic_grade = self._extract_grade(critic_analysis)
+                should_use_critic = self._should_invoke_code_critic(original_user_prompt, main_text, implementation_results)
+                should_use_art_critic = self._should_invoke_art_critic(original_user_prompt, main_text, implementation_results)
 
-                if should_use_art_critic and self.grading_enabled:
-                    yield {"type": "system", "content": "🎨 Art Critic Agent analyzing visual elements and grading..."}
-                    
-                    art_analysis = self._get_art_critique(original_user_prompt, main_response.text, implementation_results)
-                    if art_analysis:
-                        yield {"type": "agent", "agent": "🎭 Art Critic", "content": art_analysis}
-                        art_grade = self._extract_grade(art_analysis)
+                grades = {"code": None, "art": None}
+
+                if self.grading_enabled and (should_use_critic or should_use_art_critic):
+                    with self.tracer.span("critics", attempt=self.current_attempt):
+                        async for event in self._run_critique_stage(
+                            original_user_prompt, main_text, implementation_results,
+                            should_use_critic, should_use_art_critic, grades
+                        ):
+                            yield event
+                critic_grade, art_grade = grades["code"], grades["art"]
 
                 # Phase 3: Grade Evaluation and Retry Decision
                 if self.grading_enabled and (critic_grade is not None or art_grade is not None):
                     overall_grade = self._calculate_overall_grade(critic_grade, art_grade)
                     yield {"type": "system", "content": f"📊 Overall Grade: {overall_grade}/100"}
-                    
-                    if overall_grade < 70 and self.current_attempt < self.max_retry_attempts:
-                        yield {"type": "system", "content": f"⚠️ Grade below 70. Requesting Main Coder to improve... (Attempt {self.current_attempt + 1}/{self.max_retry_attempts})"}
+
+                    grade_history.append(overall_grade)
+                    usage = self.usage_ledger.totals(since=usage_mark)
+                    decision = self.retry_policy.decide(
+                        grade_history, time.perf_counter() - started, usage["input_tokens"] + usage["output_tokens"]
+                    )
+                    yield {"type": "retry_decision", "content": self.retry_policy.describe(decision), "decision": decision}
+
+                    if decision["retry"]:
                         retry_intro = f"RETRY (Original User Prompt: '{original_user_prompt}'):\n\nPREVIOUS ATTEMPT FEEDBACK:\nCode Critic Grade: {critic_grade or 'N/A'}\nArt Critic Grade: {art_grade or 'N/A'}\nOverall Grade: {overall_grade}/100\n\nPlease improve the implementation based on the critique feedback above."
                         current_main_coder_prompt = f"{retry_intro}\n\n{enhanced_user_prompt}"
                         continue  # Retry with improved prompt
-                    elif overall_grade >= 70:
-                        yield {"type": "system", "content": f"✅ Grade acceptable ({overall_grade}/100). Implementation approved!"}
-                    else:
-                        yield {"type": "system", "content": f"⚠️ Maximum attempts reached. Final grade: {overall_grade}/100"}
 
                 # Phase 4: Collaborative Refinement (only if agents were involved and refinement needed)
                 if (should_use_critic or should_use_art_critic) and self._needs_refinement(implementation_results):
                     yield {"type": "system", "content": "🔄 Agents collaborating on final refinements..."}
-                    refinement_suggestions = self._get_collaborative_refinement()
+                    with self.tracer.span("refinement"):
+                        refinement_suggestions = await self._get_collaborative_refinement()
                     if refinement_suggestions:
                         yield {"type": "agent", "agent": "🤝 Collaborative", "content": refinement_suggestions}
 
@@ -336,7 +1967,493 @@ class EnhancedMultiAgentSystem:
                 yield {"type": "error", "content": error_msg}
                 break  # Exit on system errors
 
-    def _get_code_critique(self, user_prompt, main_response, implementation_results):
+    async def _run_best_of_n(self, original_user_prompt, enhanced_user_prompt):
+        """Generate candidate_count implementations concurrently and promote the best-graded one.
+
+        Every candidate works on its own scratch copy of the project and is
+        graded by the critics there; only the winner's file changes are
+        copied back into the session's project directory. The candidates take
+        the place of the retry loop, so the retry policy is not applied to the
+        winner: a below-passing winner is still promoted, as the best of the
+        attempts made.
+        """
+        session = self.session
+        count = self.candidate_count
+        yield {"type": "system", "content": f"🧪 Main Coder generating {count} candidate implementations in parallel..."}
+
+        with self.tracer.span("context_build", attempt=1) as span:
+            main_prompt_parts = await asyncio.to_thread(self._build_main_prompt, enhanced_user_prompt)
+            span["attributes"]["parts"], span["attributes"]["bytes"] = self._measure_contents(main_prompt_parts)
+        prefix_parts = self.last_context_report["prefix_parts"]
+        if self.last_context_report["dropped"] or "delta" in self.last_context_report:
+            yield {"type": "system", "content": self._format_context_report(self.last_context_report)}
+
+        scratches = []
+        try:
+            with self.tracer.span("candidates", count=count):
+                scratches = await asyncio.gather(*[
+                    asyncio.to_thread(self._create_scratch_session, session) for _ in range(count)
+                ])
+                tasks = [
+                    asyncio.create_task(
+                        self._run_candidate(index, scratch, baseline, main_prompt_parts, original_user_prompt, prefix_parts),
+                        name=f"candidate_{index + 1}"
+                    )
+                    for index, (scratch, baseline) in enumerate(scratches)
+                ]
+                candidates = []
+                try:
+                    for next_done in asyncio.as_completed(tasks):
+                        candidate = await next_done
+                        candidates.append(candidate)
+                        if candidate["error"]:
+                            yield {"type": "error", "content": f"❌ Candidate {candidate['index'] + 1} failed: {candidate['error']}"}
+                        else:
+                            yield {"type": "system", "content": f"🧪 Candidate {candidate['index'] + 1}/{count} graded {candidate['grade']}/100 ({len(candidate['changes'][0])} files changed)"}
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)  # Stop them before their copies go
+
+            graded = [candidate for candidate in candidates if not candidate["error"]]
+            if not graded:
+                yield {"type": "error", "content": "❌ No candidate implementation succeeded."}
+                return
+            best = max(graded, key=lambda candidate: (candidate["grade"], -candidate["index"]))
+
+            self._log_interaction("user", enhanced_user_prompt)
+            self._log_interaction("main_coder", best["text"])
+            yield {"type": "agent", "agent": "🤖 Main Coder", "content": best["text"]}
+            for result in best["results"]:
+                if result["type"] != "file_changed":  # Scratch paths; promoted files are reported below
+                    yield result
+            for agent_name, analysis in best["critiques"]:
+                self._log_interaction("code_critic" if agent_name == "📊 Code Critic" else "art_critic", analysis)
+                yield {"type": "agent", "agent": agent_name, "content": analysis}
+
+            yield {"type": "system", "content": f"🏆 Promoting candidate {best['index'] + 1} (grade {best['grade']}/100)"}
+            with self.tracer.span("promotion", candidate=best["index"] + 1):
+                changed, deleted = await asyncio.to_thread(
+                    self._promote_scratch, best["session"], session.project_dir, best["changes"]
+                )
+            self.project_context["recent_changes"].extend(best["session"].project_context["recent_changes"])
+            self.project_index.invalidate()
+            for rel_path in changed:
+                yield {"type": "file_changed", "content": str(session.project_dir / rel_path)}
+            yield {"type": "system", "content": f"✅ Promoted {len(changed)} changed and {len(deleted)} deleted files"}
+            if self.grading_enabled and best["grade"] < self.retry_policy.pass_grade:
+                yield {"type": "system", "content": (
+                    f"⚠️ Best candidate is below the passing grade ({best['grade']}/{self.retry_policy.pass_grade}); "
+                    f"best-of-N does not retry. Send a follow-up prompt to refine it."
+                )}
+            yield {"type": "system", "content": "✅ Multi-agent analysis complete!"}
+        finally:
+            for scratch, _ in scratches:
+                shutil.rmtree(scratch.project_dir, ignore_errors=True)
+
+    def _create_scratch_session(self, session):
+        """Copy the session's project into a temporary directory and open a session on it.
+
+        Returns the scratch session and a (size, mtime) baseline of the copy.
+        """
+        scratch_dir = Path(tempfile.mkdtemp(prefix="candidate_"))
+        if session.project_dir.exists():
+            shutil.copytree(session.project_dir, scratch_dir, dirs_exist_ok=True)
+        scratch = AgentSession(scratch_dir)
+        # Spans and usage roll up into the parent session
+        scratch.tracer = session.tracer
+        scratch.usage_ledger = session.usage_ledger
+        scratch.context_cache_slot = session.context_cache_slot  # Candidates share the parent's prefix caches
+        scratch.conversation_history = list(session.conversation_history)
+        scratch.error_context = list(session.error_context)
+        return scratch, self._scan_tree(scratch_dir)
+
+    def _scan_tree(self, root):
+        """Map relative file paths under root to (size, mtime_ns)."""
+        tree = {}
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                full_path = Path(dirpath) / filename
+                try:
+                    stat = full_path.stat()
+                except OSError:
+                    continue  # Removed while walking, e.g. a temp file deleted by run_command
+                tree[full_path.relative_to(root).as_posix()] = (stat.st_size, stat.st_mtime_ns)
+        return tree
+
+    def _scratch_changes(self, scratch, baseline):
+        """Files a candidate created or modified, and files it deleted, relative to its copy."""
+        current = self._scan_tree(scratch.project_dir)
+        changed = sorted(path for path, stat in current.items() if baseline.get(path) != stat)
+        deleted = sorted(path for path in baseline if path not in current)
+        return changed, deleted
+
+    def _promote_scratch(self, scratch, project_dir, changes):
+        """Copy a candidate's changes into the real project directory."""
+        changed, deleted = changes
+        for rel_path in changed:
+            destination = project_dir / rel_path
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(scratch.project_dir / rel_path, destination)
+        for rel_path in deleted:
+            (project_dir / rel_path).unlink(missing_ok=True)
+            # Remove directories the candidate emptied and removed as well
+            parent = (project_dir / rel_path).parent
+            while (parent != project_dir and parent.is_dir() and not any(parent.iterdir())
+                   and not (scratch.project_dir / parent.relative_to(project_dir)).exists()):
+                parent.rmdir()
+                parent = parent.parent
+        return changed, deleted
+
+    async def _run_candidate(self, index, scratch, baseline, main_prompt_parts, original_user_prompt, prefix_parts=0):
+        """Generate, apply and grade one candidate inside its scratch session."""
+        current_session.set(scratch)  # This task runs in its own copy of the context
+        candidate = {"index": index, "session": scratch, "text": "", "results": [], "critiques": [],
+                     "grade": None, "changes": ([], []), "error": None}
+        try:
+            with self.tracer.span(f"candidate_{index + 1}"):
+                # Distinct seeds keep candidates apart (and out of each other's cache entries)
+                config = types.GenerateContentConfig(seed=index)
+                response = await self._generate_content(
+                    "main_coder", main_prompt_parts, config=config, prefix_parts=prefix_parts
+                )
+                candidate["text"] = response.text or ""
+                async for result in self._process_enhanced_commands(candidate["text"]):
+                    candidate["results"].append(result)
+                candidate["changes"] = await asyncio.to_thread(self._scratch_changes, scratch, baseline)
+                await asyncio.to_thread(self._update_project_context)
+
+                use_code_critic = self._should_invoke_code_critic(original_user_prompt, candidate["text"], candidate["results"])
+                use_art_critic = self._should_invoke_art_critic(original_user_prompt, candidate["text"], candidate["results"])
+                grades = {"code": None, "art": None}
+                async for event in self._run_critique_stage(
+                    original_user_prompt, candidate["text"], candidate["results"],
+                    use_code_critic, use_art_critic, grades
+                ):
+                    if event["type"] == "agent":
+                        candidate["critiques"].append((event["agent"], event["content"]))
+                candidate["grade"] = self._calculate_overall_grade(grades["code"], grades["art"])
+        except Exception as e:
+            candidate["error"] = str(e)
+        return candidate
+
+    def _preflight_context(self):
+        """Scan the project and load changed files ahead of the prompt build (blocking file I/O)."""
+        with self.tracer.span("context_preflight") as span:
+            self._update_project_context()
+            span["attributes"]["entries"] = len(self.snapshot_cache.refresh())
+
+    def _build_main_prompt(self, user_prompt):
+        """Refresh project context and build the Main Coder prompt (blocking file I/O)."""
+        self._update_project_context()
+        return self._build_enhanced_prompt(user_prompt, MAIN_AGENT_PROMPT, delta=self.delta_context_enabled)
+
+    async def _stream_agent_response(self, agent_name, contents, command_results=None, role="main_coder",
+                                     prefix_parts=0):
+        """Stream an agent response, yielding each text chunk as it arrives.
+
+        Emits agent_stream_start / agent_chunk / agent_stream_end messages; the
+        end message carries the full response text. When command_results is a
+        list, commands are scheduled on a CommandGraph as soon as they are
+        complete in the stream and their results are appended to it. The first
+        prefix_parts parts of contents may be served from a context cache.
+        """
+        # Read the stream in its own task so tokens keep arriving while commands run
+        chunk_queue = asyncio.Queue()
+
+        parts_sent, bytes_sent = self._measure_contents(contents)
+
+        async def pump_stream():
+            try:
+                with self.tracer.span(f"model:{role}", model=TEXT_MODEL_NAME, parts_sent=parts_sent,
+                                      bytes_sent=bytes_sent, streamed=True) as span:
+                    started = time.perf_counter()
+                    cache_key, cached = await asyncio.to_thread(
+                        self._lookup_cached_response, role, TEXT_MODEL_NAME, contents
+                    )
+                    span["attributes"]["cached"] = cached is not None
+                    if cached is not None:
+                        span["attributes"]["response_chars"] = len(cached.text or "")
+                        self.usage_ledger.record(role, TEXT_MODEL_NAME, None, time.perf_counter() - started,
+                                                 response_cache_hit=True)
+                        chunk_queue.put_nowait(("chunk", cached.text or ""))
+                        chunk_queue.put_nowait(("end", None))
+                        return
+
+                    texts = []
+                    usage_metadata = None
+
+                    async def open_stream(request_contents, request_config):
+                        # Wait for the first chunk, so a missing cache fails here and can still fall back
+                        stream = await self.client.aio.models.generate_content_stream(
+                            model=TEXT_MODEL_NAME,
+                            contents=request_contents,
+                            config=request_config
+                        )
+                        try:
+                            return [await stream.__anext__()], stream
+                        except StopAsyncIteration:
+                            return [], stream
+
+                    first_chunks, stream = await self._send_with_context_cache(
+                        open_stream, role, TEXT_MODEL_NAME, contents, None, prefix_parts, span
+                    )
+
+                    async def chunks():
+                        for chunk in first_chunks:
+                            yield chunk
+                        async for chunk in stream:
+                            yield chunk
+
+                    async for chunk in chunks():
+                        if chunk.usage_metadata is not None:
+                            usage_metadata = chunk.usage_metadata  # The last chunk carries the totals
+                        if chunk.text:
+                            if not texts:
+                                span["attributes"]["first_chunk_s"] = round(time.perf_counter() - started, 4)
+                            texts.append(chunk.text)
+                            chunk_queue.put_nowait(("chunk", chunk.text))
+                    usage = self.usage_ledger.record(role, TEXT_MODEL_NAME, usage_metadata, time.perf_counter() - started)
+                    span["attributes"]["response_chars"] = sum(len(text) for text in texts)
+                    span["attributes"]["input_tokens"] = usage["input_tokens"]
+                    span["attributes"]["output_tokens"] = usage["output_tokens"]
+                    if cache_key:
+                        await asyncio.to_thread(self.response_cache.put, cache_key, self._text_response("".join(texts)))
+                chunk_queue.put_nowait(("end", None))
+            except Exception as e:
+                chunk_queue.put_nowait(("error", e))
+
+        pump = asyncio.create_task(pump_stream(), name=f"stream:{role}")
+        graph = self._create_command_graph()
+        try:
+            yield {"type": "agent_stream_start", "agent": agent_name}
+            extractor = IncrementalCommandExtractor()
+            chunks = []
+            while True:
+                kind, payload = await chunk_queue.get()
+                if kind == "error":
+                    raise payload
+                if kind == "end":
+                    break
+
+                chunks.append(payload)
+                yield {"type": "agent_chunk", "agent": agent_name, "content": payload}
+
+                if command_results is not None:
+                    for command_str in extractor.feed(payload):
+                        graph.add(command_str)
+                    for result in graph.ready():
+                        command_results.append(result)
+                        yield result
+
+            async for result in graph.results():
+                command_results.append(result)
+                yield result
+        finally:
+            pump.cancel()  # No-op once the stream has finished
+            await graph.cancel()
+
+        yield {"type": "agent_stream_end", "agent": agent_name, "content": "".join(chunks)}
+
+    def _measure_contents(self, contents):
+        """Return (part count, approximate byte size) of request contents."""
+        if isinstance(contents, str):
+            return 1, len(contents.encode("utf-8"))
+        parts, size = 0, 0
+        for part in contents:
+            parts += 1
+            if isinstance(part, str):
+                size += len(part.encode("utf-8"))
+            elif isinstance(part, dict) and "text" in part:
+                size += len(part["text"].encode("utf-8"))
+            elif isinstance(part, dict) and "inline_data" in part:
+                size += len(part["inline_data"]["data"])
+        return parts, size
+
+    def _response_chars(self, response):
+        """Length of the text parts of a response, without touching non-text parts."""
+        candidates = getattr(response, "candidates", None) or []
+        if not candidates or not candidates[0].content or not candidates[0].content.parts:
+            return 0
+        return sum(len(part.text or "") for part in candidates[0].content.parts)
+
+    def _lookup_cached_response(self, role, model, contents, config=None):
+        """Return (cache_key, cached_response); cache_key is None when caching is off for role."""
+        if role not in self.response_cache_roles:
+            return None, None
+        cache_key = self.response_cache.make_key(model, contents, config)
+        return cache_key, self.response_cache.get(cache_key)
+
+    async def _attach_context_cache(self, role, model, contents, config, prefix_parts):
+        """Replace the first prefix_parts parts by a context cache handle when possible.
+
+        Returns the (contents, config) to send; unchanged when caching is off
+        or the prefix cannot be cached.
+        """
+        if not self.context_caching_enabled or not prefix_parts or prefix_parts >= len(contents):
+            return contents, config
+        prefix = contents[:prefix_parts]
+        cache_name = await self.context_cache.resolve(
+            self._context_cache_slot(role), model, prefix, self._estimate_parts_tokens(prefix)
+        )
+        if cache_name is None:
+            return contents, config
+        config = (config.model_copy(update={"cached_content": cache_name}) if config
+                  else types.GenerateContentConfig(cached_content=cache_name))
+        return contents[prefix_parts:], config
+
+    def _context_cache_slot(self, role):
+        return f"{self.session.context_cache_slot}:{role}"
+
+    async def _send_with_context_cache(self, send, role, model, contents, config, prefix_parts, span):
+        """Call send(contents, config) with the prompt prefix served from a context cache.
+
+        If the call fails while a cache is attached (it may have expired or
+        been deleted server-side), the cache is dropped and the full prompt is
+        sent once instead. Used by both the streaming and non-streaming paths.
+        """
+        request_contents, request_config = await self._attach_context_cache(role, model, contents, config, prefix_parts)
+        span["attributes"]["context_cache"] = request_config is not config
+        try:
+            return await send(request_contents, request_config)
+        except Exception:
+            if request_config is config:
+                raise
+            await self.context_cache.forget(self._context_cache_slot(role))
+            span["attributes"]["context_cache"] = False
+            return await send(contents, config)
+
+    async def _generate_content(self, role, contents, model=TEXT_MODEL_NAME, config=None, prefix_parts=0):
+        """Single entry point for non-streaming model calls, served from the response cache when enabled.
+
+        The first prefix_parts parts of contents are a stable prefix that may
+        be served from a context cache instead of being sent again.
+        """
+        parts_sent, bytes_sent = self._measure_contents(contents)
+        with self.tracer.span(f"model:{role}", model=model, parts_sent=parts_sent, bytes_sent=bytes_sent) as span:
+            started = time.perf_counter()
+            cache_key, cached = await asyncio.to_thread(self._lookup_cached_response, role, model, contents, config)
+            span["attributes"]["cached"] = cached is not None
+            if cached is not None:
+                span["attributes"]["response_chars"] = self._response_chars(cached)
+                self.usage_ledger.record(role, model, None, time.perf_counter() - started, response_cache_hit=True)
+                return cached
+
+            async def send(request_contents, request_config):
+                return await self.client.aio.models.generate_content(
+                    model=model, contents=request_contents, config=request_config
+                )
+
+            response = await self._send_with_context_cache(send, role, model, contents, config, prefix_parts, span)
+            usage = self.usage_ledger.record(role, model, response.usage_metadata, time.perf_counter() - started)
+            span["attributes"]["response_chars"] = self._response_chars(response)
+            span["attributes"]["input_tokens"] = usage["input_tokens"]
+            span["attributes"]["output_tokens"] = usage["output_tokens"]
+            if cache_key:
+                await asyncio.to_thread(self.response_cache.put, cache_key, response)
+            return response
+
+    def _text_response(self, text):
+        """Wrap plain text in a response object, e.g. to cache a finished stream."""
+        return types.GenerateContentResponse(candidates=[
+            types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))
+        ])
+
+    async def _run_critique_stage(self, user_prompt, main_response, implementation_results,
+                                  use_code_critic, use_art_critic, grades):
+        """Run the selected critics as concurrent tasks and yield each critique as soon as it arrives.
+
+        Grades are stored in the grades dict under "code" and "art".
+        """
+        if use_code_critic and use_art_critic and self.combined_critique_enabled:
+            parts = await asyncio.to_thread(
+                self._build_combined_critique_prompt, user_prompt, main_response, implementation_results
+            )
+            # Only worth it when the merged request fits the same budget as the Main Coder context
+            if self._estimate_parts_tokens(parts) <= self.context_packer.token_budget:
+                yield {"type": "system", "content": "🧾 Code and Art Critics grading together in one request..."}
+                with self.tracer.span("combined_critic"):
+                    sections = await self._get_combined_critique(parts)
+                if sections:
+                    for key, role, agent_name, analysis in (
+                        ("code", "code_critic", "📊 Code Critic", sections[0]),
+                        ("art", "art_critic", "🎭 Art Critic", sections[1]),
+                    ):
+                        self._log_interaction(role, analysis)
+                        yield {"type": "agent", "agent": agent_name, "content": analysis}
+                        grades[key] = self._extract_grade(analysis)
+                    return
+                yield {"type": "system", "content": "ℹ️ Combined critique was incomplete. Asking the critics separately..."}
+
+        critics = {}
+        if use_code_critic:
+            yield {"type": "system", "content": "🔍 Code Critic Agent performing deep analysis and grading..."}
+            critics["code"] = (self._get_code_critique, "📊 Code Critic")
+        if use_art_critic:
+            yield {"type": "system", "content": "🎨 Art Critic Agent analyzing visual elements and grading..."}
+            critics["art"] = (self._get_art_critique, "🎭 Art Critic")
+
+        async def traced_critique(key, critique_fn):
+            with self.tracer.span(f"{key}_critic"):
+                return key, await critique_fn(user_prompt, main_response, implementation_results)
+
+        tasks = [
+            asyncio.create_task(traced_critique(key, critique_fn), name=f"{key}_critic")
+            for key, (critique_fn, _) in critics.items()
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                key, analysis = await next_done  # Critique helpers handle their own errors
+                if analysis:
+                    yield {"type": "agent", "agent": critics[key][1], "content": analysis}
+                    grades[key] = self._extract_grade(analysis)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _build_combined_critique_prompt(self, user_prompt, main_response, implementation_results):
+        """Build one request carrying both critics' rubrics, the shared context and the project images."""
+        system_prompt = (f"{COMBINED_CRITIQUE_PROMPT}\n--- CODE CRITIQUE RUBRIC ---\n{CRITIC_AGENT_PROMPT}\n"
+                         f"--- ART CRITIQUE RUBRIC ---\n{ART_AGENT_PROMPT}")
+        return self._build_visual_context(f"""
+ORIGINAL REQUEST: {user_prompt}
+
+MAIN CODER IMPLEMENTATION: {main_response}
+
+IMPLEMENTATION RESULTS: {self._format_results(implementation_results)}
+
+PROJECT CONTEXT: {self._get_project_summary()}
+
+Please provide both the code review (quality, security, performance, best practices) and the visual review (design, aesthetics, user experience), each with its own grade.
+""", system_prompt)
+
+    def _estimate_parts_tokens(self, parts):
+        """Approximate prompt tokens of request parts; images count as a full-size prepared image."""
+        tokens = 0
+        for part in parts:
+            if "text" in part:
+                tokens += self.context_packer.estimate_text_tokens(part["text"])
+            else:
+                tokens += self.context_packer.estimate_image_tokens((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+        return tokens
+
+    async def _get_combined_critique(self, parts):
+        """Ask for both critiques in one call; returns (code, art) texts or None if it fails."""
+        try:
+            response = await self._generate_content("combined_critic", parts, prefix_parts=len(parts) - 1)
+        except Exception as e:
+            self.error_context.append(f"Combined Critic Error: {e}")
+            return None
+        return self._split_combined_critique(response.text or "")
+
+    def _split_combined_critique(self, text):
+        """Split a combined critique at its markers, or None if either section is missing."""
+        match = re.search(r"=+\s*CODE CRITIQUE\s*=+(.*?)=+\s*ART CRITIQUE\s*=+(.*)", text, re.DOTALL | re.IGNORECASE)
+        if not match or not match.group(1).strip() or not match.group(2).strip():
+            return None
+        return match.group(1).strip(), match.group(2).strip()
+
+    async def _get_code_critique(self, user_prompt, main_response, implementation_results):
         """Get enhanced code critique"""
         critique_context = f"""
 ORIGINAL REQUEST: {user_prompt}
@@ -349,11 +2466,10 @@ PROJECT CONTEXT: {self._get_project_summary()}
 
 Please provide a comprehensive code review focusing on quality, security, performance, and best practices.
 """
-        
+
         try:
-            response = self.client.models.generate_content(
-                model=TEXT_MODEL_NAME,
-                contents=[{"text": f"{CRITIC_AGENT_PROMPT}\n\n{critique_context}"}]
+            response = await self._generate_content(
+                "code_critic", [{"text": f"{CRITIC_AGENT_PROMPT}\n\n"}, {"text": critique_context}], prefix_parts=1
             )
             self._log_interaction("code_critic", response.text)
             return response.text
@@ -361,9 +2477,9 @@ Please provide a comprehensive code review focusing on quality, security, perfor
             self.error_context.append(f"Code Critic Error: {e}")
             return None
 
-    def _get_art_critique(self, user_prompt, main_response, implementation_results):
+    async def _get_art_critique(self, user_prompt, main_response, implementation_results):
         """Get enhanced art critique with vision capabilities"""
-        art_context_parts = self._build_visual_context(f"""
+        art_context_parts = await asyncio.to_thread(self._build_visual_context, f"""
 ORIGINAL REQUEST: {user_prompt}
 
 MAIN CODER IMPLEMENTATION: {main_response}
@@ -372,19 +2488,16 @@ IMPLEMENTATION RESULTS: {self._format_results(implementation_results)}
 
 Please analyze visual elements, provide design guidance, and suggest improvements for better aesthetics and user experience.
 """, ART_AGENT_PROMPT)
-        
+
         try:
-            response = self.client.models.generate_content(
-                model=TEXT_MODEL_NAME,
-                contents=art_context_parts
-            )
+            response = await self._generate_content("art_critic", art_context_parts, prefix_parts=len(art_context_parts) - 1)
             self._log_interaction("art_critic", response.text)
             return response.text
         except Exception as e:
             self.error_context.append(f"Art Critic Error: {e}")
             return None
 
-    def _get_collaborative_refinement(self):
+    async def _get_collaborative_refinement(self):
         """Get collaborative refinement suggestions"""
         if len(self.conversation_history) < 3:
             return None
@@ -402,10 +2515,7 @@ Focus on actionable improvements that leverage all three agent perspectives.
 """
         
         try:
-            response = self.client.models.generate_content(
-                model=TEXT_MODEL_NAME,
-                contents=[{"text": refinement_context}]
-            )
+            response = await self._generate_content("collaborative", [{"text": refinement_context}])
             return response.text
         except Exception as e:
             return None
@@ -418,69 +2528,177 @@ Focus on actionable improvements that leverage all three agent perspectives.
             "recent_changes": self._get_recent_changes()
         }
 
-    def _build_enhanced_prompt(self, user_prompt, system_prompt):
-        """Build enhanced prompt with comprehensive context"""
-        prompt_parts = [{"text": f"{system_prompt}\n\n**PROJECT STATUS:**\n"}]
-
-        # Add current files with content
-        if VM_DIR.exists():
-            for root, _, files in os.walk(VM_DIR):
-                for name in sorted(files):
-                    rel_path = os.path.relpath(os.path.join(root, name), VM_DIR)
-                    file_path = os.path.join(root, name)
-                    
-                    try:
-                        if name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                            try:
-                                img = Image.open(file_path)
-                                prompt_parts.append({"text": f"\n--- IMAGE: {rel_path} ---\n"})
-                                prompt_parts.append(img)
-                            except Exception:
-                                prompt_parts.append({"text": f"\n--- IMAGE ERROR: {rel_path} ---\n"})
-                        else:
-                            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                                content = f.read(3000)  # Increased content limit
-                            prompt_parts.append({"text": f"\n--- FILE: {rel_path} ---\n{content}\n"})
-                    except IOError:
-                        continue
+    def _build_enhanced_prompt(self, user_prompt, system_prompt, delta=False):
+        """Build enhanced prompt with the most relevant context that fits the token budget
+
+        With delta set, the project snapshot of an earlier turn is kept as the
+        prompt prefix while the Main Coder's context cache still holds it, and
+        only files changed since then are added after it. Without a live cache
+        (caching off, expired, or the snapshot too far out of date) every file
+        is sent again and becomes the new snapshot.
+        """
+        header = {"text": f"{system_prompt}\n\n**PROJECT STATUS:**\n"}
+        request = {"text": f"\n**USER REQUEST:**\n{user_prompt}"}
+        entries = self.snapshot_cache.refresh()
+        candidates = self._file_candidates(entries)
+
+        base = self.context_base if delta else None
+        rebase_reason = "first snapshot"
+        if base is not None and not self.context_caching_enabled:
+            base, rebase_reason = None, "context caching is off"
+        elif base is not None and not self.context_cache.holds(self._context_cache_slot("main_coder"), base["digest"]):
+            base, rebase_reason = None, "the cached snapshot expired or was never cached"
+        changed = set()
+        if base is not None:
+            changed = {
+                candidate["label"] for candidate in candidates
+                if base["hashes"].get(candidate["label"]) != candidate["hash"]
+            }
+            changed_tokens = sum(candidate["tokens"] for candidate in candidates if candidate["label"] in changed)
+            if changed_tokens > base["tokens"] * self.delta_context_rebase_ratio:
+                base, rebase_reason = None, "too many files changed"
+            elif base["tokens"] > self.context_packer.token_budget:
+                base, rebase_reason = None, "the token budget shrank below the snapshot"
+
+        unchanged = 0
+        if base is not None:
+            # Files in the cached prefix are only sent again once they change; files
+            # the budget left out of the snapshot stay ordinary candidates
+            unchanged = sum(
+                1 for candidate in candidates
+                if candidate["label"] in base["shown"] and candidate["label"] not in changed
+            )
+            candidates = [
+                candidate for candidate in candidates
+                if candidate["label"] not in base["shown"] or candidate["label"] in changed
+            ]
+            present = {entry["path"] for entry in entries}
+            deleted = sorted(path for path in base["shown"] if path not in present)
+            if deleted:
+                text = f"\n**DELETED SINCE THE SNAPSHOT ABOVE:**\n{chr(10).join('- ' + path for path in deleted)}\n"
+                candidates.append({
+                    "kind": "manifest", "label": "deleted files", "parts": [{"text": text}],
+                    "tokens": self.context_packer.estimate_text_tokens(text)
+                })
 
         # Add conversation history for context
         if self.conversation_history:
-            prompt_parts.append({"text": "\n**CONVERSATION HISTORY:**\n"})
+            history_parts = [{"text": "\n**CONVERSATION HISTORY:**\n"}]
             for entry in self.conversation_history[-8:]:  # More history
                 role = entry["role"].replace("_", " ").title()
                 content = entry["content"][:300] + "..." if len(entry["content"]) > 300 else entry["content"]
-                prompt_parts.append({"text": f"{role}: {content}\n\n"})
+                history_parts.append({"text": f"{role}: {content}\n\n"})
+            candidates.append({
+                "kind": "history", "label": "conversation history", "parts": history_parts,
+                "tokens": sum(self.context_packer.estimate_text_tokens(part["text"]) for part in history_parts)
+            })
 
         # Add error context if any
         if self.error_context:
-            prompt_parts.append({"text": f"\n**RECENT ERRORS:**\n{chr(10).join(self.error_context[-3:])}\n"})
+            text = f"\n**RECENT ERRORS:**\n{chr(10).join(self.error_context[-3:])}\n"
+            candidates.append({
+                "kind": "errors", "label": "recent errors", "parts": [{"text": text}],
+                "tokens": self.context_packer.estimate_text_tokens(text)
+            })
 
-        prompt_parts.append({"text": f"\n**USER REQUEST:**\n{user_prompt}"})
+        recent_paths = [
+            change["args"][0] for change in self.project_context.get("recent_changes", [])
+            if change.get("args")
+        ]
+        prefix = base["parts"] if base is not None else [header]
+        reserved = self._estimate_parts_tokens(prefix) + self.context_packer.estimate_text_tokens(request["text"])
+        selected, report = self.context_packer.pack(
+            candidates, user_prompt, reserved_tokens=reserved, recent_paths=recent_paths
+        )
+        # Changed files the budget left out: the model only has their outdated snapshot copy
+        stale = [label for label in report["dropped"] if label in base["shown"]] if base is not None else []
+        report["unchanged"] = unchanged
+        report["stale"] = stale
+
+        prompt_parts = list(prefix)
+        if base is not None and any(candidate["kind"] in ("file", "image") for candidate in selected):
+            prompt_parts.append({"text": "\n**FILES CHANGED SINCE THE SNAPSHOT ABOVE (these contents replace it):**\n"})
+        for candidate in selected:
+            prompt_parts.extend(candidate["parts"])
+        if stale:
+            prompt_parts.append({"text": (
+                "\n**CHANGED SINCE THE SNAPSHOT ABOVE BUT LEFT OUT FOR SPACE (the snapshot copy is outdated):**\n"
+                + "\n".join(f"- {label}" for label in stale) + "\n"
+            )})
+        prompt_parts.append(request)
+
+        if base is not None:
+            report["prefix_parts"] = len(prefix)
+            report["delta"] = f"{unchanged} unchanged files served from the cached snapshot"
+        else:
+            # Files and images come first, so the header and those parts form a cacheable prefix
+            prefix_parts = 1 + sum(
+                len(candidate["parts"]) for candidate in selected if candidate["kind"] in ("file", "image")
+            )
+            report["prefix_parts"] = prefix_parts
+            if delta:
+                prefix = prompt_parts[:prefix_parts]
+                self.context_base = {
+                    "parts": prefix,
+                    "hashes": {entry["path"]: entry["hash"] for entry in entries},
+                    "shown": {
+                        candidate["label"] for candidate in selected if candidate["kind"] in ("file", "image")
+                    },
+                    "digest": self.context_cache.digest(TEXT_MODEL_NAME, prefix),
+                    "tokens": self._estimate_parts_tokens(prefix),
+                }
+                if not self.context_caching_enabled:
+                    report["delta"] = "inactive, context caching is off; all files sent"
+                elif self.context_base["tokens"] < self.context_cache.min_tokens:
+                    report["delta"] = (f"inactive, the snapshot (~{self.context_base['tokens']:,} tokens) is below "
+                                       f"the {self.context_cache.min_tokens:,}-token caching minimum; all files sent")
+                else:
+                    self.context_cache.expect_reuse(self.context_base["digest"])  # Later turns resend it unchanged
+                    report["delta"] = f"new snapshot taken ({rebase_reason}); all files sent"
+        self.last_context_report = report
         return prompt_parts
 
+    def _file_candidates(self, entries):
+        """Context candidates for the project's files and images."""
+        candidates = []
+        for entry in entries:
+            rel_path = entry["path"]
+            if entry["is_image"]:
+                if entry["image"] is not None:
+                    parts = [{"text": f"\n--- IMAGE: {rel_path} ---\n"}, entry["image"]]
+                    tokens = self.context_packer.estimate_image_tokens(entry["image_size"])
+                else:
+                    parts = [{"text": f"\n--- IMAGE ERROR: {rel_path} ---\n"}]
+                    tokens = self.context_packer.estimate_text_tokens(parts[0]["text"])
+                candidates.append({"kind": "image", "label": rel_path, "hash": entry["hash"], "parts": parts, "tokens": tokens})
+            else:
+                text = f"\n--- FILE: {rel_path} ---\n{entry['text']}\n"
+                candidates.append({
+                    "kind": "file", "label": rel_path, "hash": entry["hash"], "text": entry["text"],
+                    "parts": [{"text": text}], "tokens": self.context_packer.estimate_text_tokens(text)
+                })
+        return candidates
+
     def _build_visual_context(self, context_text, system_prompt):
-        """Build visual context for art critic with all images"""
-        context_parts = [{"text": f"{system_prompt}\n\n{context_text}\n\n**VISUAL CONTEXT:**\n"}]
+        """Build visual context for art critic with all images
+
+        The request text comes last, so everything before it is a stable
+        prefix that can be served from a context cache.
+        """
+        context_parts = [{"text": f"{system_prompt}\n\n**VISUAL CONTEXT:**\n"}]
         
-        if VM_DIR.exists():
+        if self.session.project_dir.exists():
             image_count = 0
-            for root, _, files in os.walk(VM_DIR):
-                for name in files:
-                    if name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                        file_path = os.path.join(root, name)
-                        rel_path = os.path.relpath(file_path, VM_DIR)
-                        try:
-                            img = Image.open(file_path)
-                            context_parts.append({"text": f"\n--- ANALYZING IMAGE: {rel_path} ---\n"})
-                            context_parts.append(img)
-                            image_count += 1
-                        except Exception:
-                            continue
+            for entry in self.snapshot_cache.refresh():
+                if entry["is_image"] and entry["image"] is not None:
+                    context_parts.append({"text": f"\n--- ANALYZING IMAGE: {entry['path']} ---\n"})
+                    context_parts.append(entry["image"])
+                    image_count += 1
             
             if image_count == 0:
                 context_parts.append({"text": "No images found in project.\n"})
         
+        context_parts.append({"text": f"\n{context_text}"})
         return context_parts
 
     def _should_invoke_code_critic(self, user_prompt, main_response, implementation_results):
@@ -556,102 +2774,120 @@ Focus on actionable improvements that leverage all three agent perspectives.
 
     def _has_project_images(self):
         """Check if project contains images"""
-        if not VM_DIR.exists():
-            return False
-        
-        for root, _, files in os.walk(VM_DIR):
-            for name in files:
-                if name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                    return True
-        return False
-
-    def _process_enhanced_commands(self, response_text):
-        """Enhanced command processing with a more specific regex, pre-checks, and detailed error logging."""
-        # Regex to find function-like calls: command_name(arguments)
-        # It looks for a valid identifier, followed by '(', any characters (non-greedy), and then ')'
-        # Allows for optional whitespace around the command itself within the backticks.
-        command_pattern = re.compile(r'`\s*([a-zA-Z_][\w\.]*\s*\(.*?\))\s*`', re.DOTALL)
-        matches = command_pattern.finditer(response_text)
-
-        for match in matches:
-            command_str = match.group(1).strip() # command_str is now the pure command like "create_file(...)"
+        return self.project_index.has_images()
 
-            if not command_str:
-                continue
-
-            # Pre-check if the command string starts with a known command handler name followed by an opening parenthesis
-            # This helps filter out malformed or unintended matches before attempting ast.parse
-            if not any(command_str.startswith(known_cmd + "(") for known_cmd in self.command_handlers.keys()):
-                # Optionally log this as a skipped potential command if debugging is needed
-                # self.error_context.append(f"Skipped potential command (unknown prefix): '{command_str[:50]}...'")
-                yield {"type": "system", "content": f"ℹ️ Note: Ignoring potential command-like text: `{command_str[:100]}{'...' if len(command_str) > 100 else ''}`"}
-                continue
-
-            try:
-                # Attempt to parse the command string as a Python expression (specifically, a function call)
-                parsed_expr = ast.parse(command_str, mode="eval")
-                call_node = parsed_expr.body
-                
-                # Ensure it's a Call node (function call)
-                if not isinstance(call_node, ast.Call):
-                    # This should ideally be caught by the regex, but as a safeguard:
-                    self.error_context.append(f"Command parsing error: Not a function call - '{command_str}'")
-                    yield {"type": "error", "content": f"❌ Command error: Not a function call - `{command_str}`"}
-                    continue
+    async def _process_enhanced_commands(self, response_text):
+        """Run the response's commands, in parallel where they touch unrelated paths, yielding results in command order.
 
-                func_name = call_node.func.id
-                if func_name not in self.command_handlers:
-                    self.error_context.append(f"Unknown command: '{func_name}' in '{command_str}'")
-                    yield {"type": "error", "content": f"❌ Unknown command: `{func_name}`"}
-                    continue
+        Requested images form a batch: they are generated concurrently under
+        the shared image limiter and report progress as each one finishes.
+        """
+        graph = self._create_command_graph()
+        try:
+            for command_str in IncrementalCommandExtractor().feed(response_text):
+                graph.add(command_str)
+            async for result in graph.results():
+                yield result
+        finally:
+            await graph.cancel()
+
+    def _create_command_graph(self):
+        return CommandGraph(self._run_traced_command, self.command_workers, live_commands=("generate_image",))
+
+    async def _run_traced_command(self, command_str):
+        with self.tracer.span(f"command:{command_str.split('(', 1)[0].strip()}"):
+            async for result in self._execute_command(command_str):
+                yield result
+
+    async def _run_blocking(self, func, *args):
+        """Run a blocking command handler on a worker thread.
+
+        A thread cannot be interrupted, so if the caller is cancelled this
+        still waits for the handler to finish before re-raising; once a
+        cancelled command has stopped, it no longer touches the project.
+        """
+        future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.gather(future, return_exceptions=True)
+            raise
+
+    async def _execute_command(self, command_str):
+        """Parse and run a single backticked command string, yielding its results."""
+        if not command_str:
+            return
 
-                # Safely evaluate arguments
-                args = []
-                for arg_node in call_node.args:
-                    try:
-                        args.append(ast.literal_eval(arg_node))
-                    except ValueError as ve:
-                        # Handle cases where an argument is not a simple literal (e.g., a variable or complex expression)
-                        # For now, we'll log and skip this command as it's not supported by literal_eval
-                        error_msg = f"Command argument error: Non-literal argument in '{command_str}'. Argument: {ast.dump(arg_node)}. Error: {ve}"
-                        self.error_context.append(error_msg)
-                        yield {"type": "error", "content": f"❌ Command error: Invalid argument in `{command_str}`"}
-                        break  # Break from processing args for this command
-                else: # This 'else' belongs to the for loop, executed if the loop completed without a 'break'
-                    result = self.command_handlers[func_name](*args)
-
-                    if func_name == "generate_image":
-                        for update in result: # generate_image is a generator
-                            yield update
-                    else:
-                        yield {"type": "system", "content": result}
+        # Pre-check if the command string starts with a known command handler name followed by an opening parenthesis
+        # This helps filter out malformed or unintended matches before attempting ast.parse
+        if not any(command_str.startswith(known_cmd + "(") for known_cmd in self.command_handlers.keys()):
+            # Optionally log this as a skipped potential command if debugging is needed
+            # self.error_context.append(f"Skipped potential command (unknown prefix): '{command_str[:50]}...'")
+            yield {"type": "system", "content": f"ℹ️ Note: Ignoring potential command-like text: `{command_str[:100]}{'...' if len(command_str) > 100 else ''}`"}
+            return
 
-                    # Track successful changes
-                    if func_name in ["create_file", "write_to_file", "generate_image"]:
-                        self.project_context["recent_changes"].append({
-                            "command": func_name,
-                            "args": args, # Log sanitized args
-                            "timestamp": time.time()
-                        })
-                    continue # Move to the next matched command
+        try:
+            # Attempt to parse the command string as a Python expression (specifically, a function call)
+            parsed_expr = ast.parse(command_str, mode="eval")
+            call_node = parsed_expr.body
+            
+            # Ensure it's a Call node (function call)
+            if not isinstance(call_node, ast.Call):
+                # This should ideally be caught by the regex, but as a safeguard:
+                self.error_context.append(f"Command parsing error: Not a function call - '{command_str}'")
+                yield {"type": "error", "content": f"❌ Command error: Not a function call - `{command_str}`"}
+                return
 
-                # If the for loop for args was broken (due to bad arg), skip to next command match
-                if args and isinstance(args[-1], Exception): # Check if loop was broken by an error
-                     continue
+            func_name = call_node.func.id
+            if func_name not in self.command_handlers:
+                self.error_context.append(f"Unknown command: '{func_name}' in '{command_str}'")
+                yield {"type": "error", "content": f"❌ Unknown command: `{func_name}`"}
+                return
 
+            # Safely evaluate arguments
+            args = []
+            for arg_node in call_node.args:
+                try:
+                    args.append(ast.literal_eval(arg_node))
+                except ValueError as ve:
+                    # Handle cases where an argument is not a simple literal (e.g., a variable or complex expression)
+                    # For now, we'll log and skip this command as it's not supported by literal_eval
+                    error_msg = f"Command argument error: Non-literal argument in '{command_str}'. Argument: {ast.dump(arg_node)}. Error: {ve}"
+                    self.error_context.append(error_msg)
+                    yield {"type": "error", "content": f"❌ Command error: Invalid argument in `{command_str}`"}
+                    return  # Skip this command
+
+            if func_name == "generate_image":
+                async for update in self.generate_image(*args): # generate_image is an async generator
+                    yield update
+            else:
+                # File and shell handlers block, so they run on a worker thread
+                result = await self._run_blocking(self.command_handlers[func_name], *args)
+                yield {"type": "system", "content": result}
+
+            # Any command may have touched the project tree
+            self.project_index.invalidate()
+
+            # Track successful changes
+            if func_name in ["create_file", "write_to_file", "generate_image"]:
+                self.project_context["recent_changes"].append({
+                    "command": func_name,
+                    "args": args, # Log sanitized args
+                    "timestamp": time.time()
+                })
 
-            except SyntaxError as se:
-                error_msg = f"Command syntax error: Unable to parse '{command_str}'. Error: {se}"
-                self.error_context.append(error_msg)
-                yield {"type": "error", "content": f"❌ Command syntax error: `{command_str}`"}
-            except ValueError as ve: # Catches errors from ast.literal_eval if the whole command_str was somehow evaluated
-                error_msg = f"Command value error: Problem with argument values in '{command_str}'. Error: {ve}"
-                self.error_context.append(error_msg)
-                yield {"type": "error", "content": f"❌ Command value error: `{command_str}`"}
-            except Exception as e: # General catch-all for other unexpected errors
-                error_msg = f"Unexpected command execution error for '{command_str}'. Error: {type(e).__name__} - {e}"
-                self.error_context.append(error_msg)
-                yield {"type": "error", "content": f"❌ Unexpected error processing command: `{command_str}`"}
+        except SyntaxError as se:
+            error_msg = f"Command syntax error: Unable to parse '{command_str}'. Error: {se}"
+            self.error_context.append(error_msg)
+            yield {"type": "error", "content": f"❌ Command syntax error: `{command_str}`"}
+        except ValueError as ve: # Catches errors from ast.literal_eval if the whole command_str was somehow evaluated
+            error_msg = f"Command value error: Problem with argument values in '{command_str}'. Error: {ve}"
+            self.error_context.append(error_msg)
+            yield {"type": "error", "content": f"❌ Command value error: `{command_str}`"}
+        except Exception as e: # General catch-all for other unexpected errors
+            error_msg = f"Unexpected command execution error for '{command_str}'. Error: {type(e).__name__} - {e}"
+            self.error_context.append(error_msg)
+            yield {"type": "error", "content": f"❌ Unexpected error processing command: `{command_str}`"}
 
     def _log_interaction(self, role, content):
         """Logs an interaction to the conversation history, maintaining a manageable length."""
@@ -675,6 +2911,20 @@ Focus on actionable improvements that leverage all three agent perspectives.
             formatted.append(f"- {result.get('type', 'unknown')}: {result.get('content', '')}")
         return "\n".join(formatted)
 
+    def _format_context_report(self, report):
+        """Summarize what the context packer kept and dropped."""
+        dropped = report["dropped"]
+        summary = (f"📦 Context: {report['included']}/{report['total']} parts, "
+                   f"~{report['used']:,}/{report['budget']:,} tokens.")
+        if dropped:
+            listed = ", ".join(dropped[:8]) + (f" (+{len(dropped) - 8} more)" if len(dropped) > 8 else "")
+            summary += f" Dropped ~{report['dropped_tokens']:,} tokens: {listed}"
+        if report.get("stale"):
+            summary += f"\n⚠️ Changed but left out, so the model sees an outdated copy: {', '.join(report['stale'])}"
+        if "delta" in report:
+            summary += f"\nDelta context: {report['delta']}"
+        return summary
+
     def _get_project_summary(self):
         """Gets a concise summary of the current project state (file counts)."""
         file_count = len(self.project_context.get("files", []))
@@ -699,25 +2949,11 @@ Focus on actionable improvements that leverage all three agent perspectives.
 
     def _get_project_files(self):
         """Get list of project files"""
-        files = []
-        if VM_DIR.exists():
-            for root, _, filenames in os.walk(VM_DIR):
-                for name in filenames:
-                    if not name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                        rel_path = os.path.relpath(os.path.join(root, name), VM_DIR)
-                        files.append(rel_path)
-        return files
+        return [info["path"] for info in self.project_index.text_files()]
 
     def _get_project_images(self):
         """Get list of project images"""
-        images = []
-        if VM_DIR.exists():
-            for root, _, filenames in os.walk(VM_DIR):
-                for name in filenames:
-                    if name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                        rel_path = os.path.relpath(os.path.join(root, name), VM_DIR)
-                        images.append(rel_path)
-        return images
+        return [info["path"] for info in self.project_index.images()]
 
     def _get_recent_changes(self):
         """Get recent project changes"""
@@ -749,7 +2985,7 @@ Focus on actionable improvements that leverage all three agent perspectives.
         return sum(grades) // len(grades)  # Average of available grades
 
     def _safe_path(self, filename):
-        """Sanitize file paths to ensure they are within VM_DIR and prevent traversal."""
+        """Sanitize file paths to ensure they are within the session's project directory and prevent traversal."""
         if not filename: # Disallow empty filenames
             return None
 
@@ -757,21 +2993,21 @@ Focus on actionable improvements that leverage all three agent perspectives.
         if Path(filename).is_absolute():
             return None
 
-        # Combine with VM_DIR and then normalize
+        # Combine with the project directory and then normalize
         # os.path.abspath will normalize the path (e.g., remove '..') and make it absolute.
-        # This helps in comparing it reliably against the VM_DIR's absolute path.
-        # It's crucial that VM_DIR is an absolute path for this comparison or that both are treated consistently.
-        # Since VM_DIR is Path('vm'), it's relative to the execution directory.
+        # This helps in comparing it reliably against the project directory's absolute path.
+        # The default session uses VM_DIR (Path('vm')), which is relative to the execution directory.
 
-        abs_vm_dir = os.path.abspath(VM_DIR)
+        project_dir = self.session.project_dir
+        abs_vm_dir = os.path.abspath(project_dir)
 
         # Construct the full path
-        full_path = VM_DIR / filename
+        full_path = project_dir / filename
         abs_full_path = os.path.abspath(full_path)
 
-        # Check if the normalized full path starts with the normalized VM_DIR path
+        # Check if the normalized full path starts with the normalized project directory path
         if os.path.commonprefix([abs_full_path, abs_vm_dir]) != abs_vm_dir:
-            return None # Path is outside VM_DIR or filename tries to escape
+            return None # Path is outside the project or filename tries to escape
 
         # Additionally, ensure that the resolved path doesn't escape via symlinks
         # This is harder to do perfectly without actually resolving, which might fail for create_file.
@@ -779,7 +3015,7 @@ Focus on actionable improvements that leverage all three agent perspectives.
         # For now, we rely on the abspath check. A more advanced check might involve Path.resolve()
         # but would need careful handling if the path doesn't exist yet.
 
-        return full_path # Return the Path object, still relative to execution if VM_DIR is
+        return full_path # Return the Path object, still relative to execution if the project directory is
 
     def _create_file(self, path, content=""):
         """Create new file with enhanced error handling"""
@@ -851,7 +3087,7 @@ Focus on actionable improvements that leverage all three agent perspectives.
 
             proc = subprocess.run(
                 cmd_parts, # Pass as a list
-                cwd=VM_DIR,
+                cwd=self.session.project_dir,
                 shell=False, # Set to False for security
                 capture_output=True,
                 text=True,
@@ -883,7 +3119,7 @@ Focus on actionable improvements that leverage all three agent perspectives.
             self.error_context.append(error_msg)
             return error_msg
 
-    def generate_image(self, path, prompt):
+    async def generate_image(self, path, prompt):
         """Enhanced image generation with better feedback"""
         if not self.client:
             yield {"type": "error", "content": "❌ Image generation not configured"}
@@ -899,11 +3135,8 @@ Focus on actionable improvements that leverage all three agent perspectives.
 
         try:
             config = types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"])
-            response = self.client.models.generate_content(
-                model=IMAGE_MODEL_NAME,
-                contents=prompt,
-                config=config
-            )
+            async with self.image_limiter:  # Shared with every other session's image requests
+                response = await self._generate_content("image_generator", prompt, model=IMAGE_MODEL_NAME, config=config)
 
             image_bytes = None
             candidates = getattr(response, "candidates", [])
@@ -918,16 +3151,11 @@ Focus on actionable improvements that leverage all three agent perspectives.
                 yield {"type": "error", "content": "❌ No image data received from AI"}
                 return
 
-            filepath.parent.mkdir(parents=True, exist_ok=True)
-            filepath.write_bytes(image_bytes)
-            
-            # Get image info
-            try:
-                img = Image.open(filepath)
-                width, height = img.size
-                file_size = filepath.stat().st_size
-                yield {"type": "system", "content": f"✅ Image generated: {width}x{height}px, {file_size} bytes"}
-            except Exception:
+            image_info = await self._run_blocking(self._save_image, filepath, image_bytes)
+            if image_info:
+                width, height, file_size = image_info
+                yield {"type": "system", "content": f"✅ Image generated: {path} ({width}x{height}px, {file_size} bytes)"}
+            else:
                 yield {"type": "system", "content": f"✅ Image generated: {path}"}
             
             yield {"type": "file_changed", "content": str(filepath)}
@@ -937,6 +3165,106 @@ Focus on actionable improvements that leverage all three agent perspectives.
             self.error_context.append(error_msg)
             yield {"type": "error", "content": error_msg}
 
+    def _save_image(self, filepath, image_bytes):
+        """Write generated image bytes; returns (width, height, size) or None if unreadable."""
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        filepath.write_bytes(image_bytes)
+        try:
+            with Image.open(filepath) as img:
+                width, height = img.size
+            return width, height, filepath.stat().st_size
+        except Exception:
+            return None
+
+# -----------------------------------------------------------------------------
+# Prompt Scheduling
+# -----------------------------------------------------------------------------
+class PromptScheduler:
+    """Queue of prompts run one at a time on a session, highest priority first.
+
+    Every event of a running prompt is passed to on_event(job, event), along
+    with {"type": "queue_changed"} whenever the queue changes and {"type":
+    "done"} when a prompt finishes. Queued prompts can be cancelled before
+    they start; cancelling the running prompt aborts its in-flight model
+    calls and the commands it has not run yet.
+    """
+    PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+    def __init__(self, engine, on_event, session=None):
+        self.engine = engine
+        self.on_event = on_event
+        self.session = session
+        self.running = None
+        self._queue = []  # Heap of (priority, job id, job)
+        self._next_id = 1
+        self._condition = threading.Condition()
+        threading.Thread(target=self._worker, name="prompt-scheduler", daemon=True).start()
+
+    def submit(self, text, priority="normal"):
+        """Queue a prompt and return its job dict."""
+        with self._condition:
+            job = {"id": self._next_id, "text": text, "priority": priority, "status": "queued", "submitted": time.time()}
+            self._next_id += 1
+            heapq.heappush(self._queue, (self.PRIORITIES[priority], job["id"], job))
+            self._condition.notify()
+        self.on_event(job, {"type": "queue_changed"})
+        return job
+
+    def jobs(self):
+        """The running job followed by queued jobs in the order they will run."""
+        with self._condition:
+            queued = [job for _, _, job in sorted(self._queue, key=lambda item: item[:2])]
+            return ([self.running] if self.running else []) + queued
+
+    def cancel(self, job_id):
+        """Drop a queued job or abort the running one; returns False if the job is unknown."""
+        with self._condition:
+            for index, (_, _, job) in enumerate(self._queue):
+                if job["id"] == job_id:
+                    del self._queue[index]
+                    heapq.heapify(self._queue)
+                    job["status"] = "cancelled"
+                    break
+            else:
+                job = self.running
+                if job is None or job["id"] != job_id:
+                    return False
+                job["status"] = "cancelling"
+                self.engine.cancel_interaction(self.session)
+        self.on_event(job, {"type": "queue_changed"})
+        return True
+
+    def cancel_all(self):
+        """Cancel the running job and empty the queue."""
+        for job in self.jobs():
+            self.cancel(job["id"])
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                _, _, job = heapq.heappop(self._queue)
+                job["status"] = "running"
+                self.running = job
+            self.on_event(job, {"type": "queue_changed"})
+
+            try:
+                for event in self.engine.run_enhanced_interaction(job["text"], self.session):
+                    if job["status"] == "cancelling":
+                        # The cancel may have arrived before the interaction started
+                        self.engine.cancel_interaction(self.session)
+                    self.on_event(job, event)
+            except Exception as e:
+                self.on_event(job, {"type": "error", "content": f"Enhanced Agent System Error: {e}"})
+
+            with self._condition:
+                job["status"] = "cancelled" if job["status"] == "cancelling" else "done"
+                self.running = None
+            self.on_event(job, {"type": "queue_changed"})
+            self.on_event(job, {"type": "done"})
+
+
 # -----------------------------------------------------------------------------
 # Enhanced IDE Application
 # -----------------------------------------------------------------------------
@@ -951,13 +3279,15 @@ class EnhancedGeminiIDE(tk.Tk):
         self.msg_queue = queue.Queue()
         self.current_image = None
         self.current_open_file_path = None
+        self.streaming_chat_sender = None
+        self.prompt_scheduler = None
 
         self._create_enhanced_menu()
         self._create_enhanced_layout()
         self._create_enhanced_status_bar()
 
         api_key = load_api_key()
-        if not api_key and GENAI_IMPORTED:
+        if not api_key and GENAI_IMPORTED and BACKEND != "local":
             self.prompt_api_key()
         elif GENAI_IMPORTED:
             self.configure_enhanced_agents(api_key)
@@ -1091,6 +3421,35 @@ class EnhancedGeminiIDE(tk.Tk):
         self.insights.pack(fill=tk.BOTH, expand=True)
         self.notebook.add(insights_frame, text="📊 Project Insights")
 
+        # Phase trace tab
+        trace_frame = ttk.Frame(self.notebook)
+        trace_toolbar = ttk.Frame(trace_frame)
+        trace_toolbar.pack(fill=tk.X, pady=(5, 0))
+        ttk.Button(trace_toolbar, text="💾 Export JSONL", command=self.export_trace_jsonl).pack(side=tk.LEFT, padx=5)
+        ttk.Button(trace_toolbar, text="💾 Export Chrome Trace", command=self.export_chrome_trace).pack(side=tk.LEFT)
+        self.trace_view = scrolledtext.ScrolledText(
+            trace_frame,
+            wrap=tk.NONE,
+            font=("Consolas", 10),
+            padx=15,
+            pady=15,
+            state="disabled",
+            bg="#fffaf0"
+        )
+        self.trace_view.pack(fill=tk.BOTH, expand=True)
+        self.notebook.add(trace_frame, text="⏱️ Phase Trace")
+
+        # Prompt queue: the running prompt first, then queued prompts in run order
+        queue_frame = ttk.LabelFrame(right_frame, text="📋 Prompt Queue", padding=3)
+        queue_frame.pack(fill=tk.X, pady=(0, 5))
+        self.prompt_queue_list = tk.Listbox(queue_frame, height=3, font=("Segoe UI", 9), activestyle="none")
+        self.prompt_queue_list.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        queue_buttons = ttk.Frame(queue_frame)
+        queue_buttons.pack(side=tk.RIGHT, fill=tk.Y)
+        ttk.Button(queue_buttons, text="⏹️ Cancel Selected", command=self.cancel_selected_prompt).pack(fill=tk.X)
+        ttk.Button(queue_buttons, text="⏹️ Cancel All", command=self.cancel_all_prompts).pack(fill=tk.X, pady=(3, 0))
+        self.prompt_queue_jobs = []
+
         # Enhanced input area
         input_frame = ttk.Frame(right_frame)
         input_frame.pack(fill=tk.X, pady=(0, 5))
@@ -1108,6 +3467,7 @@ class EnhancedGeminiIDE(tk.Tk):
         )
         self.input_txt.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
         self.input_txt.bind("<Control-Return>", lambda e: self.send_enhanced_prompt())
+        self.input_txt.bind("<Escape>", lambda e: self.cancel_running_prompt())
         self.input_txt.insert("1.0", "💬 Ask the multi-agent system anything... (Ctrl+Enter to send)")
         self.input_txt.bind("<FocusIn>", self._clear_placeholder)
         self.input_txt.bind("<FocusOut>", self._restore_placeholder)
@@ -1139,6 +3499,16 @@ class EnhancedGeminiIDE(tk.Tk):
             width=3
         )
         self.screenshot_btn.pack(side=tk.LEFT, padx=(0, 3), anchor='center') # Adjusted padding
+
+        # Priority for newly queued prompts
+        self.priority_var = tk.StringVar(value="normal")
+        ttk.Combobox(
+            control_button_frame,
+            textvariable=self.priority_var,
+            values=list(PromptScheduler.PRIORITIES),
+            width=7,
+            state="readonly"
+        ).pack(side=tk.LEFT, padx=(0, 3), anchor='center')
         
         # Enhanced send button
         self.send_btn = ttk.Button(
@@ -1259,6 +3629,7 @@ class EnhancedGeminiIDE(tk.Tk):
         """Configure enhanced multi-agent system"""
         try:
             self.agent_system = EnhancedMultiAgentSystem(api_key)
+            self.prompt_scheduler = PromptScheduler(self.agent_system, self._on_scheduler_event)
             self.status_var.set("✅ Enhanced Multi-Agent System configured")
             self.add_chat_message("System", "🚀 Enhanced Multi-Agent System ready!\n\n🤖 Main Coder Agent - Vision-enabled implementation\n📊 Code Critic Agent - Deep analysis & security\n🎨 Art Critic Agent - Visual analysis & design")
             self._draw_enhancer_toggle_switch() # Initial draw of the custom toggle switch
@@ -1277,10 +3648,10 @@ class EnhancedGeminiIDE(tk.Tk):
         insights.append("=" * 50)
         
         # File analysis
-        file_count = len(self.agent_system._get_project_files())
-        image_count = len(self.agent_system._get_project_images())
-        insights.append(f"📁 Files: {file_count}")
-        insights.append(f"🖼️ Images: {image_count}")
+        counts = self.agent_system.project_index.counts()
+        insights.append(f"📁 Files: {counts['files']}")
+        insights.append(f"🖼️ Images: {counts['images']}")
+        insights.append(f"💾 Size: {self._format_file_size(counts['bytes'])}")
         
         # Recent changes
         recent_changes = len(self.agent_system._get_recent_changes())
@@ -1298,8 +3669,46 @@ class EnhancedGeminiIDE(tk.Tk):
         self.insights.insert("1.0", "\n".join(insights))
         self.insights.config(state="disabled")
 
+    def update_trace_view(self):
+        """Show the spans recorded during the last interaction"""
+        if not hasattr(self, 'agent_system'):
+            return
+
+        lines = ["⏱️ PHASE TRACE (last interaction)", "=" * 50, "   offset  duration  span"]
+        lines.extend(self.agent_system.tracer.format_spans() or ["No spans recorded yet."])
+
+        self.trace_view.config(state="normal")
+        self.trace_view.delete("1.0", tk.END)
+        self.trace_view.insert("1.0", "\n".join(lines))
+        self.trace_view.config(state="disabled")
+
+    def export_trace_jsonl(self):
+        """Export the last interaction's spans as JSON lines"""
+        self._export_trace("JSONL", ".jsonl", lambda path: self.agent_system.tracer.export_jsonl(path))
+
+    def export_chrome_trace(self):
+        """Export the last interaction's spans as a Chrome trace-event file"""
+        self._export_trace("Chrome Trace", ".json", lambda path: self.agent_system.tracer.export_chrome_trace(path))
+
+    def _export_trace(self, label, extension, exporter):
+        from tkinter import filedialog
+
+        if not hasattr(self, 'agent_system'):
+            return
+        path = filedialog.asksaveasfilename(
+            title=f"Export {label}",
+            defaultextension=extension,
+            filetypes=[(f"{label} files", f"*{extension}"), ("All files", "*.*")]
+        )
+        if path:
+            try:
+                exporter(path)
+                self.status_var.set(f"💾 Trace exported: {path}")
+            except Exception as e:
+                self.status_var.set(f"❌ Trace export error: {str(e)}")
+
     def send_enhanced_prompt(self):
-        """Send enhanced prompt to multi-agent system"""
+        """Queue the prompt for the multi-agent system"""
         text = self.input_txt.get("1.0", tk.END).strip()
         if not text or text.startswith("💬 Ask the multi-agent"):
             return
@@ -1307,32 +3716,58 @@ class EnhancedGeminiIDE(tk.Tk):
         self.add_chat_message("👤 You", text)
         self.input_txt.delete("1.0", tk.END)
 
-        self.input_txt.config(state="disabled")
-        self.send_btn.config(state="disabled")
-        self.screenshot_btn.config(state="disabled") # Disable screenshot button during processing
-        self.status_var.set("🔄 Enhanced Multi-Agent System Processing...")
+        if self.prompt_scheduler is None:
+            self.add_chat_message("❌ Error", "Enhanced Multi-Agent System not configured. Set API key.", "#ff0000")
+            return
+
+        job = self.prompt_scheduler.submit(text, self.priority_var.get())
+        if len(self.prompt_scheduler.jobs()) > 1:
+            self.status_var.set(f"📋 Prompt #{job['id']} queued ({job['priority']} priority)")
+        else:
+            self.status_var.set("🔄 Enhanced Multi-Agent System Processing...")
 
         # Update agent status to processing
         self.main_status.config(foreground="orange")
         self.critic_status.config(foreground="orange")  
         self.art_status.config(foreground="orange")
 
-        threading.Thread(
-            target=self._process_enhanced_prompt, 
-            args=(text,),
-            daemon=True
-        ).start()
-
-    def _process_enhanced_prompt(self, text):
-        """Process enhanced prompt with multi-agent system"""
-        if not hasattr(self, 'agent_system') or self.agent_system is None:
-            self.msg_queue.put({"type": "error", "content": "Enhanced Multi-Agent System not configured. Set API key."})
-            self.msg_queue.put({"type": "done"})
-            return
+    def _on_scheduler_event(self, job, event):
+        """Forward scheduler events (from its worker thread) to the UI queue"""
+        self.msg_queue.put(event)
+
+    def update_prompt_queue_view(self):
+        """Refresh the prompt queue list"""
+        self.prompt_queue_jobs = self.prompt_scheduler.jobs() if self.prompt_scheduler else []
+        self.prompt_queue_list.delete(0, tk.END)
+        status_icons = {"running": "🔄", "cancelling": "⏹️", "queued": "⏳"}
+        for job in self.prompt_queue_jobs:
+            preview = job["text"].replace("\n", " ")
+            preview = preview[:80] + "..." if len(preview) > 80 else preview
+            self.prompt_queue_list.insert(
+                tk.END, f"{status_icons.get(job['status'], '•')} #{job['id']} [{job['priority']}] {preview}"
+            )
 
-        for response in self.agent_system.run_enhanced_interaction(text):
-            self.msg_queue.put(response)
-        self.msg_queue.put({"type": "done"})
+    def cancel_selected_prompt(self):
+        """Cancel the prompt selected in the queue"""
+        selection = self.prompt_queue_list.curselection()
+        if not selection or not self.prompt_scheduler:
+            return
+        job = self.prompt_queue_jobs[selection[0]]
+        if self.prompt_scheduler.cancel(job["id"]):
+            self.status_var.set(f"⏹️ Cancelling prompt #{job['id']}")
+
+    def cancel_running_prompt(self):
+        """Cancel the prompt that is currently running"""
+        if self.prompt_scheduler and self.prompt_scheduler.running:
+            job = self.prompt_scheduler.running
+            self.prompt_scheduler.cancel(job["id"])
+            self.status_var.set(f"⏹️ Cancelling prompt #{job['id']}")
+
+    def cancel_all_prompts(self):
+        """Cancel the running prompt and clear the queue"""
+        if self.prompt_scheduler:
+            self.prompt_scheduler.cancel_all()
+            self.status_var.set("⏹️ Cancelling all prompts")
 
     def _process_messages(self):
         """Enhanced message processing"""
@@ -1342,14 +3777,7 @@ class EnhancedGeminiIDE(tk.Tk):
 
                 if msg["type"] == "agent":
                     agent_name = msg["agent"]
-                    agent_colors = {
-                        "🤖 Main Coder": "#2E8B57",
-                        "📊 Code Critic": "#FF6347",
-                        "🎭 Art Critic": "#9370DB",
-                        "✨ Prompt Enhancer": "#FFD700", # Gold color for enhancer
-                        "🤝 Collaborative": "#4169E1"
-                    }
-                    color = agent_colors.get(agent_name, "#000000")
+                    color = AGENT_COLORS.get(agent_name, "#000000")
                     self.add_chat_message(agent_name, msg["content"], color)
                 elif msg["type"] == "system":
                     self.add_chat_message("🔧 System", msg["content"], "#2E8B57")
@@ -1409,6 +3837,8 @@ class EnhancedGeminiIDE(tk.Tk):
 
     def refresh_files(self):
         """Enhanced file tree refresh with metadata"""
+        if hasattr(self, 'agent_system'):
+            self.agent_system.project_index.invalidate()
         self.tree.delete(*self.tree.get_children())
         self._populate_enhanced_tree(VM_DIR, "")
 
@@ -1455,8 +3885,17 @@ class EnhancedGeminiIDE(tk.Tk):
 
     def add_chat_message(self, sender, message, color="#000000"):
         """Enhanced chat message with better formatting"""
+        self._end_chat_stream()
         self.chat.config(state="normal")
+        self._insert_chat_header(sender, color)
+        self.chat.insert(tk.END, f"{message}\n\n", "message")
         
+        self.chat.see(tk.END)
+        self.chat.config(state="disabled")
+        self.notebook.select(1)  # Switch to chat tab
+
+    def _insert_chat_header(self, sender, color):
+        """Insert the timestamp and sender line that starts every chat message."""
         # Create timestamp
         timestamp = time.strftime("[%H:%M:%S] ")
         
@@ -1468,14 +3907,35 @@ class EnhancedGeminiIDE(tk.Tk):
         self.chat.tag_configure("timestamp", foreground="gray", font=("Segoe UI", 9))
         self.chat.tag_configure("message", font=("Segoe UI", 11))
         
-        # Insert message
+        # Insert header
         self.chat.insert(tk.END, timestamp, "timestamp")
         self.chat.insert(tk.END, f"{sender}:\n", sender_tag)
-        self.chat.insert(tk.END, f"{message}\n\n", "message")
-        
+
+    def begin_chat_stream(self, sender, color="#000000"):
+        """Start a chat message whose body will arrive in chunks."""
+        self._end_chat_stream()
+        self.chat.config(state="normal")
+        self._insert_chat_header(sender, color)
         self.chat.see(tk.END)
         self.chat.config(state="disabled")
         self.notebook.select(1)  # Switch to chat tab
+        self.streaming_chat_sender = sender
+
+    def append_chat_stream(self, text):
+        """Append a streamed chunk to the message opened by begin_chat_stream."""
+        self.chat.config(state="normal")
+        self.chat.insert(tk.END, text, "message")
+        self.chat.see(tk.END)
+        self.chat.config(state="disabled")
+
+    def _end_chat_stream(self):
+        """Close the currently streaming chat message, if any."""
+        if not self.streaming_chat_sender:
+            return
+        self.streaming_chat_sender = None
+        self.chat.config(state="normal")
+        self.chat.insert(tk.END, "\n\n", "message")
+        self.chat.config(state="disabled")
 
     # Additional enhanced methods
     def test_agent(self, agent_type):
@@ -1509,9 +3969,11 @@ class EnhancedGeminiIDE(tk.Tk):
         
         files = self.agent_system._get_project_files()
         images = self.agent_system._get_project_images()
+        total_bytes = self.agent_system.project_index.counts()["bytes"]
         
         stats.append(f"📁 Total Files: {len(files)}")
         stats.append(f"🖼️ Images: {len(images)}")
+        stats.append(f"💾 Project Size: {self._format_file_size(total_bytes)}")
         
         if files:
             stats.append("\n📝 CODE FILES:")
@@ -1523,6 +3985,10 @@ class EnhancedGeminiIDE(tk.Tk):
             for img in images:
                 stats.append(f"  • {img}")
         
+        if self.agent_system.usage_ledger.entries:
+            stats.append("\n💰 TOKEN USAGE (this session):")
+            stats.extend(self.agent_system.usage_ledger.format_report())
+        
         messagebox.showinfo("Project Statistics", "\n".join(stats))
 
     def show_agent_settings(self):
@@ -1534,7 +4000,7 @@ class EnhancedGeminiIDE(tk.Tk):
         # Create settings dialog
         settings_window = tk.Toplevel(self)
         settings_window.title("🤖 Agent System Settings")
-        settings_window.geometry("500x600")
+        settings_window.geometry("520x960")
         settings_window.transient(self)
         settings_window.grab_set()
         
@@ -1550,6 +4016,8 @@ class EnhancedGeminiIDE(tk.Tk):
         config_frame = ttk.LabelFrame(main_frame, text="📋 Configuration", padding=10)
         config_frame.pack(fill=tk.X, pady=(0, 10))
         
+        backend_name = "Local stand-in" if isinstance(self.agent_system.client, LocalGeminiClient) else "Gemini API"
+        ttk.Label(config_frame, text=f"• Backend: {backend_name}").pack(anchor=tk.W)
         ttk.Label(config_frame, text=f"• Text Model: {TEXT_MODEL_NAME}").pack(anchor=tk.W)
         ttk.Label(config_frame, text=f"• Image Model: {IMAGE_MODEL_NAME}").pack(anchor=tk.W)
         ttk.Label(config_frame, text="• Vision Capabilities: ✅ Enabled").pack(anchor=tk.W)
@@ -1568,6 +4036,46 @@ class EnhancedGeminiIDE(tk.Tk):
         )
         grading_check.pack(anchor=tk.W)
         
+        self.streaming_var = tk.BooleanVar(value=getattr(self.agent_system, 'streaming_enabled', True))
+        streaming_check = ttk.Checkbutton(
+            grading_frame,
+            text="Stream Main Coder responses into chat",
+            variable=self.streaming_var,
+            command=self._toggle_streaming
+        )
+        streaming_check.pack(anchor=tk.W)
+        
+        self.live_commands_var = tk.BooleanVar(value=getattr(self.agent_system, 'execute_while_streaming', True))
+        live_commands_check = ttk.Checkbutton(
+            grading_frame,
+            text="Run commands while the response is streaming",
+            variable=self.live_commands_var,
+            command=self._toggle_live_commands
+        )
+        live_commands_check.pack(anchor=tk.W)
+        
+        self.combined_critique_var = tk.BooleanVar(value=getattr(self.agent_system, 'combined_critique_enabled', True))
+        combined_critique_check = ttk.Checkbutton(
+            grading_frame,
+            text="Combine Code and Art critiques into one request when they fit",
+            variable=self.combined_critique_var,
+            command=self._toggle_combined_critique
+        )
+        combined_critique_check.pack(anchor=tk.W)
+        
+        self.delta_context_var = tk.BooleanVar(value=getattr(self.agent_system, 'delta_context_enabled', False))
+        delta_context_check = ttk.Checkbutton(
+            grading_frame,
+            text="Send only files changed since the cached project snapshot (delta context)",
+            variable=self.delta_context_var,
+            command=self._toggle_delta_context
+        )
+        delta_context_check.pack(anchor=tk.W)
+        ttk.Label(
+            grading_frame,
+            text=f"    Saves tokens only with context caching on and a project snapshot over {CONTEXT_CACHE_MIN_TOKENS:,} tokens"
+        ).pack(anchor=tk.W)
+        
         # self.prompt_enhancer_var = tk.BooleanVar(value=getattr(self.agent_system, 'prompt_enhancer_enabled', True))
         # prompt_enhancer_check = ttk.Checkbutton(
         #     grading_frame,
@@ -1577,8 +4085,137 @@ class EnhancedGeminiIDE(tk.Tk):
         # )
         # prompt_enhancer_check.pack(anchor=tk.W)
 
-        ttk.Label(grading_frame, text=f"• Max Retry Attempts: {getattr(self.agent_system, 'max_retry_attempts', 3)}").pack(anchor=tk.W)
-        ttk.Label(grading_frame, text="• Minimum Passing Grade: 70/100").pack(anchor=tk.W)
+        budget_row = ttk.Frame(grading_frame)
+        budget_row.pack(anchor=tk.W, fill=tk.X)
+        ttk.Label(budget_row, text="Context token budget:").pack(side=tk.LEFT)
+        self.context_budget_var = tk.IntVar(value=self.agent_system.context_packer.token_budget)
+        ttk.Spinbox(
+            budget_row,
+            from_=4000,
+            to=1000000,
+            increment=4000,
+            width=10,
+            textvariable=self.context_budget_var,
+            command=self._set_context_budget
+        ).pack(side=tk.LEFT, padx=(5, 0))
+
+        retry_policy = self.agent_system.retry_policy
+        improvement_row = ttk.Frame(grading_frame)
+        improvement_row.pack(anchor=tk.W, fill=tk.X)
+        ttk.Label(improvement_row, text="Stop retrying when a retry gains less than:").pack(side=tk.LEFT)
+        self.retry_improvement_var = tk.IntVar(value=retry_policy.min_improvement)
+        ttk.Spinbox(
+            improvement_row,
+            from_=0,
+            to=50,
+            increment=1,
+            width=4,
+            textvariable=self.retry_improvement_var,
+            command=self._set_retry_improvement
+        ).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(improvement_row, text="points").pack(side=tk.LEFT, padx=(3, 0))
+
+        budget_limits_row = ttk.Frame(grading_frame)
+        budget_limits_row.pack(anchor=tk.W, fill=tk.X)
+        ttk.Label(budget_limits_row, text="Stop retrying after:").pack(side=tk.LEFT)
+        self.retry_seconds_var = tk.IntVar(value=retry_policy.max_seconds or 0)
+        ttk.Spinbox(
+            budget_limits_row,
+            from_=0,
+            to=3600,
+            increment=30,
+            width=6,
+            textvariable=self.retry_seconds_var,
+            command=self._set_retry_budgets
+        ).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(budget_limits_row, text="seconds or").pack(side=tk.LEFT, padx=(3, 0))
+        self.retry_tokens_var = tk.IntVar(value=retry_policy.max_tokens or 0)
+        ttk.Spinbox(
+            budget_limits_row,
+            from_=0,
+            to=10000000,
+            increment=10000,
+            width=9,
+            textvariable=self.retry_tokens_var,
+            command=self._set_retry_budgets
+        ).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(budget_limits_row, text="tokens (0 = no budget)").pack(side=tk.LEFT, padx=(3, 0))
+
+        candidates_row = ttk.Frame(grading_frame)
+        candidates_row.pack(anchor=tk.W, fill=tk.X)
+        ttk.Label(candidates_row, text="Best-of-N candidates (1 = sequential retries):").pack(side=tk.LEFT)
+        self.candidate_count_var = tk.IntVar(value=self.agent_system.candidate_count)
+        ttk.Spinbox(
+            candidates_row,
+            from_=1,
+            to=8,
+            increment=1,
+            width=4,
+            textvariable=self.candidate_count_var,
+            command=self._set_candidate_count
+        ).pack(side=tk.LEFT, padx=(5, 0))
+
+        images_row = ttk.Frame(grading_frame)
+        images_row.pack(anchor=tk.W, fill=tk.X)
+        ttk.Label(images_row, text="Parallel image generations:").pack(side=tk.LEFT)
+        self.image_concurrency_var = tk.IntVar(value=self.agent_system.image_concurrency)
+        ttk.Spinbox(
+            images_row,
+            from_=1,
+            to=16,
+            increment=1,
+            width=4,
+            textvariable=self.image_concurrency_var,
+            command=self._set_image_limits
+        ).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(images_row, text="max per minute:").pack(side=tk.LEFT, padx=(10, 0))
+        self.image_rpm_var = tk.IntVar(value=self.agent_system.image_requests_per_minute or 0)
+        ttk.Spinbox(
+            images_row,
+            from_=0,
+            to=600,
+            increment=1,
+            width=5,
+            textvariable=self.image_rpm_var,
+            command=self._set_image_limits
+        ).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(images_row, text="(0 = no limit)").pack(side=tk.LEFT, padx=(3, 0))
+
+        ttk.Label(grading_frame, text=f"• Max Retry Attempts: {retry_policy.max_attempts}").pack(anchor=tk.W)
+        ttk.Label(grading_frame, text=f"• Minimum Passing Grade: {retry_policy.pass_grade}/100").pack(anchor=tk.W)
+        ttk.Label(grading_frame, text=f"• Time Budget: {f'{retry_policy.max_seconds}s' if retry_policy.max_seconds else 'none'}  "
+                                      f"Token Budget: {f'{retry_policy.max_tokens:,}' if retry_policy.max_tokens else 'none'}").pack(anchor=tk.W)
+        
+        # Response cache section
+        cache_frame = ttk.LabelFrame(main_frame, text="💾 Response Cache", padding=10)
+        cache_frame.pack(fill=tk.X, pady=(0, 10))
+        
+        self.response_cache_vars = {}
+        for role, agent_name in AGENT_ROLES.items():
+            var = tk.BooleanVar(value=role in self.agent_system.response_cache_roles)
+            self.response_cache_vars[role] = var
+            ttk.Checkbutton(
+                cache_frame,
+                text=f"Cache {agent_name} responses",
+                variable=var,
+                command=lambda r=role: self._toggle_response_cache(r)
+            ).pack(anchor=tk.W)
+        
+        cache_stats = self.agent_system.response_cache.stats()
+        ttk.Label(cache_frame, text=f"• Hits: {cache_stats['hits']}  Misses: {cache_stats['misses']}  Hit rate: {cache_stats['hit_rate']:.0f}%").pack(anchor=tk.W)
+        ttk.Button(cache_frame, text="🧹 Clear Response Cache", command=self._clear_response_cache).pack(anchor=tk.W, pady=(5, 0))
+        
+        self.context_caching_var = tk.BooleanVar(value=getattr(self.agent_system, 'context_caching_enabled', True))
+        ttk.Checkbutton(
+            cache_frame,
+            text="Cache system prompts and project snapshot on the server (context caching)",
+            variable=self.context_caching_var,
+            command=self._toggle_context_caching
+        ).pack(anchor=tk.W, pady=(5, 0))
+        context_stats = self.agent_system.context_cache.stats()
+        ttk.Label(cache_frame, text=f"• Cached prefixes: {context_stats['active']} ({context_stats['cached_tokens']:,} tokens)  "
+                                    f"Created: {context_stats['created']}  Reused: {context_stats['reused']}  "
+                                    f"Used once: {context_stats['deferred']}").pack(anchor=tk.W)
         
         # Agent capabilities section
         agents_frame = ttk.LabelFrame(main_frame, text="🎯 Agent Capabilities", padding=10)
@@ -1617,6 +4254,127 @@ class EnhancedGeminiIDE(tk.Tk):
             self.status_var.set(f"📊 Grading system {status}")
             self.add_chat_message("⚙️ Settings", f"Grading system {status}")
 
+    def _toggle_streaming(self):
+        """Toggle token streaming of Main Coder responses on/off"""
+        if hasattr(self, 'agent_system'):
+            self.agent_system.streaming_enabled = self.streaming_var.get()
+            status = "enabled" if self.streaming_var.get() else "disabled"
+            self.status_var.set(f"📡 Response streaming {status}")
+            self.add_chat_message("⚙️ Settings", f"Response streaming {status}")
+
+    def _toggle_live_commands(self):
+        """Toggle executing commands while the Main Coder response streams"""
+        if hasattr(self, 'agent_system'):
+            self.agent_system.execute_while_streaming = self.live_commands_var.get()
+            status = "enabled" if self.live_commands_var.get() else "disabled"
+            self.status_var.set(f"⚡ Live command execution {status}")
+            self.add_chat_message("⚙️ Settings", f"Live command execution {status}")
+
+    def _toggle_combined_critique(self):
+        """Toggle merging both critiques into a single request"""
+        if hasattr(self, 'agent_system'):
+            self.agent_system.combined_critique_enabled = self.combined_critique_var.get()
+            status = "enabled" if self.combined_critique_var.get() else "disabled"
+            self.status_var.set(f"🧾 Combined critique {status}")
+            self.add_chat_message("⚙️ Settings", f"Combined critique {status}")
+
+    def _toggle_context_caching(self):
+        """Toggle server-side caching of stable prompt prefixes"""
+        if hasattr(self, 'agent_system'):
+            self.agent_system.context_caching_enabled = self.context_caching_var.get()
+            status = "enabled" if self.context_caching_var.get() else "disabled"
+            self.status_var.set(f"🧊 Context caching {status}")
+            self.add_chat_message("⚙️ Settings", f"Context caching {status}")
+
+    def _toggle_delta_context(self):
+        """Toggle sending only changed files to the Main Coder"""
+        if hasattr(self, 'agent_system'):
+            self.agent_system.delta_context_enabled = self.delta_context_var.get()
+            status = "enabled" if self.delta_context_var.get() else "disabled"
+            self.status_var.set(f"📦 Delta context {status}")
+            message = f"Delta context {status}"
+            if self.delta_context_var.get() and not self.agent_system.context_caching_enabled:
+                message += " (inactive until context caching is turned on)"
+            self.add_chat_message("⚙️ Settings", message)
+
+    def _set_context_budget(self):
+        """Apply the context token budget chosen in the settings dialog"""
+        if hasattr(self, 'agent_system'):
+            try:
+                budget = int(self.context_budget_var.get())
+            except (tk.TclError, ValueError):
+                return
+            self.agent_system.context_packer.token_budget = budget
+            self.status_var.set(f"📦 Context budget set to {budget:,} tokens")
+
+    def _set_retry_improvement(self):
+        """Apply the minimum grade improvement chosen in the settings dialog"""
+        if hasattr(self, 'agent_system'):
+            try:
+                points = int(self.retry_improvement_var.get())
+            except (tk.TclError, ValueError):
+                return
+            self.agent_system.retry_policy.min_improvement = points
+            self.status_var.set(f"🔁 Retries stop when a retry gains less than {points} points")
+
+    def _set_image_limits(self):
+        """Apply the image generation concurrency and rate limit chosen in the settings dialog"""
+        if hasattr(self, 'agent_system'):
+            try:
+                concurrency = int(self.image_concurrency_var.get())
+                per_minute = int(self.image_rpm_var.get())
+            except (tk.TclError, ValueError):
+                return
+            self.agent_system.image_concurrency = max(1, concurrency)
+            self.agent_system.image_requests_per_minute = per_minute or None
+            limit = f"{per_minute}/min" if per_minute else "no rate limit"
+            self.status_var.set(f"🎨 Up to {max(1, concurrency)} images at once, {limit}")
+
+    def _set_retry_budgets(self):
+        """Apply the retry time and token budgets chosen in the settings dialog"""
+        if hasattr(self, 'agent_system'):
+            try:
+                seconds = int(self.retry_seconds_var.get())
+                tokens = int(self.retry_tokens_var.get())
+            except (tk.TclError, ValueError):
+                return
+            self.agent_system.max_retry_seconds = seconds or None
+            self.agent_system.max_retry_tokens = tokens or None
+            time_budget = f"{seconds}s" if seconds else "no time budget"
+            token_budget = f"{tokens:,} tokens" if tokens else "no token budget"
+            self.status_var.set(f"🔁 Retry budgets: {time_budget}, {token_budget}")
+
+    def _set_candidate_count(self):
+        """Apply the number of parallel Main Coder candidates chosen in the settings dialog"""
+        if hasattr(self, 'agent_system'):
+            try:
+                count = int(self.candidate_count_var.get())
+            except (tk.TclError, ValueError):
+                return
+            self.agent_system.candidate_count = count
+            if count > 1:
+                self.status_var.set(f"🧪 Main Coder will generate {count} candidates and keep the best")
+            else:
+                self.status_var.set("🔁 Main Coder will use sequential retries")
+
+    def _toggle_response_cache(self, role):
+        """Toggle response caching for one agent role"""
+        if hasattr(self, 'agent_system'):
+            agent_name = AGENT_ROLES[role]
+            if self.response_cache_vars[role].get():
+                self.agent_system.response_cache_roles.add(role)
+                status = "enabled"
+            else:
+                self.agent_system.response_cache_roles.discard(role)
+                status = "disabled"
+            self.status_var.set(f"💾 Response cache {status} for {agent_name}")
+
+    def _clear_response_cache(self):
+        """Delete every cached model response"""
+        if hasattr(self, 'agent_system'):
+            self.agent_system.response_cache.clear()
+            self.status_var.set("🧹 Response cache cleared")
+
     def _toggle_prompt_enhancer(self, event=None):
         """Toggle prompt enhancer system on/off - called by the UI switch."""
         if hasattr(self, 'agent_system'):
@@ -1787,6 +4545,8 @@ class EnhancedGeminiIDE(tk.Tk):
                 self.status_var.set(f"💾 Saved: {self.current_open_file_path.name} ({line_count} lines, {char_count} chars)")
                 
                 # Update insights
+                if hasattr(self, 'agent_system'):
+                    self.agent_system.project_index.invalidate()
                 self.update_agent_insights()
             except Exception as e:
                 self.status_var.set(f"❌ Save error: {str(e)}")
@@ -2074,16 +4834,18 @@ class EnhancedGeminiIDE(tk.Tk):
 
                 if msg["type"] == "agent":
                     agent_name = msg["agent"]
-                    agent_colors = {
-                        "🤖 Main Coder": "#2E8B57",
-                        "📊 Code Critic": "#FF6347",
-                        "🎭 Art Critic": "#9370DB",
-                        "✨ Prompt Enhancer": "#FFD700", # Gold color for enhancer
-                        "🤝 Collaborative": "#4169E1"
-                    }
-                    color = agent_colors.get(agent_name, "#000000")
+                    color = AGENT_COLORS.get(agent_name, "#000000")
                     self.add_chat_message(agent_name, msg["content"], color)
-                elif msg["type"] == "system":
+                elif msg["type"] == "agent_stream_start":
+                    agent_name = msg["agent"]
+                    self.begin_chat_stream(agent_name, AGENT_COLORS.get(agent_name, "#000000"))
+                elif msg["type"] == "agent_chunk":
+                    if self.streaming_chat_sender != msg["agent"]:
+                        self.begin_chat_stream(msg["agent"], AGENT_COLORS.get(msg["agent"], "#000000"))
+                    self.append_chat_stream(msg["content"])
+                elif msg["type"] == "agent_stream_end":
+                    self._end_chat_stream()
+                elif msg["type"] in ("system", "retry_decision"):
                     self.add_chat_message("🔧 System", msg["content"], "#2E8B57")
                 elif msg["type"] == "error":
                     self.add_chat_message("❌ Error", msg["content"], "#ff0000")
@@ -2107,9 +4869,17 @@ class EnhancedGeminiIDE(tk.Tk):
                         self.display_enhanced_image(changed_file_path)
                     elif self.current_open_file_path and self.current_open_file_path.samefile(changed_file_path):
                         self.display_file(self.current_open_file_path)
+                elif msg["type"] == "cancelled":
+                    self._end_chat_stream()
+                    self.add_chat_message("⏹️ Cancelled", msg["content"], "#ff6600")
+                elif msg["type"] == "queue_changed":
+                    self.update_prompt_queue_view()
                 elif msg["type"] == "done":
-                    self.input_txt.config(state="normal")
-                    self.send_btn.config(state="normal")
+                    self._end_chat_stream()
+                    self.update_trace_view()
+                    if self.prompt_scheduler and self.prompt_scheduler.jobs():
+                        self.status_var.set("🔄 Processing next queued prompt...")
+                        continue
                     self.status_var.set("✅ Enhanced Multi-Agent System Ready")
                     # Reset agent status
                     self.main_status.config(foreground="green")
@@ -2126,10 +4896,326 @@ class EnhancedGeminiIDE(tk.Tk):
         if messagebox.askokcancel("🚪 Exit", "Exit Enhanced Multi-Agent IDE?\n\nUnsaved changes will be lost."):
             self.destroy()
 
+# -----------------------------------------------------------------------------
+# Headless Batch Mode
+# -----------------------------------------------------------------------------
+def read_prompts(source, prompt_format="auto"):
+    """Read prompts from a file path or "-" for stdin.
+
+    Plain text has one prompt per line; blank lines and lines starting with #
+    are skipped. JSONL holds one {"prompt": "..."} object per line, which
+    allows multi-line prompts. With prompt_format "auto", a file is JSONL if
+    its name ends in .jsonl, and stdin is JSONL if its first prompt line is
+    such an object.
+    """
+    if source == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        lines = Path(source).read_text(encoding="utf-8").splitlines()
+    lines = [line.strip() for line in lines]
+    lines = [line for line in lines if line and not line.startswith("#")]
+
+    if prompt_format == "auto" and source == "-":
+        try:
+            first = json.loads(lines[0]) if lines else None
+        except ValueError:
+            first = None
+        is_jsonl = isinstance(first, dict) and "prompt" in first
+    elif prompt_format == "auto":
+        is_jsonl = source.endswith(".jsonl")
+    else:
+        is_jsonl = prompt_format == "jsonl"
+    return [json.loads(line)["prompt"] if is_jsonl else line for line in lines]
+
+
+def run_headless_project(project_dir, prompts, output, backend=BACKEND, settings=None):
+    """Run every prompt against one project directory and write the events as JSONL.
+
+    Each line is an event from run_enhanced_interaction tagged with the
+    project and prompt index. output is an open text stream, which is left
+    open, or a file path ("-" for stdout). Returns a summary dict. Runs in a
+    worker process when several projects are processed in parallel.
+    """
+    settings = settings or {}
+    project_dir = Path(project_dir)
+    project_dir.mkdir(parents=True, exist_ok=True)
+    engine = EnhancedMultiAgentSystem(load_api_key(), backend=backend)
+    for name, value in settings.items():
+        setattr(engine, name, value)
+    session = engine.create_session(project_dir)
+
+    summary = {"project": str(project_dir), "prompts": len(prompts), "events": 0, "errors": 0}
+    started = time.perf_counter()
+    owns_output = not hasattr(output, "write")
+    if owns_output:
+        output = sys.stdout if output == "-" else open(output, "w", encoding="utf-8")
+    try:
+        for index, prompt in enumerate(prompts):
+            for event in engine.run_enhanced_interaction(prompt, session):
+                record = {"project": str(project_dir), "prompt_index": index, "timestamp": time.time(), **event}
+                output.write(json.dumps(record, default=str) + "\n")
+                output.flush()
+                summary["events"] += 1
+                summary["errors"] += event["type"] == "error"
+    finally:
+        if owns_output and output is not sys.stdout:
+            output.close()
+    summary["seconds"] = round(time.perf_counter() - started, 2)
+    summary["usage"] = session.usage_ledger.totals()
+    return summary
+
+
+def run_headless_batch(project_dirs, prompts, output_path, jobs=1, backend=BACKEND, settings=None):
+    """Run the prompts against each project directory, in parallel across a process pool.
+
+    With one worker, events are written as they arrive. With several, each
+    project writes a part file that is appended to the output as soon as
+    that project finishes, so lines stay grouped by project.
+    """
+    output = sys.stdout if output_path == "-" else open(output_path, "w", encoding="utf-8")
+    if jobs <= 1 or len(project_dirs) == 1:
+        try:
+            return [run_headless_project(project_dir, prompts, output, backend, settings) for project_dir in project_dirs]
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+    part_dir = Path(tempfile.mkdtemp(prefix="gemini_batch_"))
+    summaries = []
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {
+                pool.submit(run_headless_project, project_dir, prompts, str(part_dir / f"{index}.jsonl"), backend, settings):
+                    part_dir / f"{index}.jsonl"
+                for index, project_dir in enumerate(project_dirs)
+            }
+            for future in as_completed(futures):
+                summaries.append(future.result())
+                with open(futures[future], encoding="utf-8") as part:
+                    shutil.copyfileobj(part, output)
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        shutil.rmtree(part_dir, ignore_errors=True)
+    return summaries
+
+
+# -----------------------------------------------------------------------------
+# HTTP Server Mode
+# -----------------------------------------------------------------------------
+class AgentServer(ThreadingHTTPServer):
+    """Local HTTP API that lets several clients share one warm engine.
+
+    POST /interactions {"prompt": "...", "project": "vm"} streams the events
+    of run_enhanced_interaction as server-sent events, ending with
+    {"type": "done"}. POST /cancel {"project": "vm"} aborts the project's
+    running interaction and GET /status reports sessions, token usage and
+    response cache statistics. Projects are directories under projects_root;
+    each keeps one session, so its snapshot cache stays warm between requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, engine, projects_root="."):
+        super().__init__(address, AgentRequestHandler)
+        self.engine = engine
+        self.projects_root = Path(projects_root).resolve()
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, project):
+        """Session for a project directory under projects_root, created on first use."""
+        project_dir = (self.projects_root / project).resolve()
+        if not project_dir.is_relative_to(self.projects_root):
+            raise ValueError(f"Project must be inside {self.projects_root}")
+        with self._lock:
+            session = self.sessions.get(project_dir)
+            if session is None:
+                try:
+                    project_dir.mkdir(parents=True, exist_ok=True)
+                except OSError as e:  # No permission, or a file already at that path
+                    raise ValueError(f"Cannot use project directory {project}: {e.strerror or e}") from e
+                session = self.sessions[project_dir] = self.engine.create_session(project_dir)
+        return session
+
+    def status(self):
+        with self._lock:
+            sessions = list(self.sessions.items())
+        return {
+            "backend": type(self.engine.client).__name__,
+            "sessions": [
+                {
+                    "project": str(project_dir.relative_to(self.projects_root)),
+                    "active": session.active,
+                    "usage": session.usage_ledger.totals(),
+                }
+                for project_dir, session in sessions
+            ],
+            "response_cache": self.engine.response_cache.stats(),
+            "context_cache": self.engine.context_cache.stats(),
+            "image_limiter": self.engine.image_limiter.stats(),
+        }
+
+
+class AgentRequestHandler(BaseHTTPRequestHandler):
+    """Request handler for AgentServer."""
+    server_version = "GeminiAgentServer/1.0"
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._send_json(200, self.server.status())
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body, dict):
+                raise ValueError("The request body must be a JSON object")
+            project = body.get("project") or str(VM_DIR)
+            if not isinstance(project, str):
+                raise ValueError("project must be a string")
+            session = self.server.get_session(project)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        if self.path == "/interactions":
+            prompt = body.get("prompt")
+            if not isinstance(prompt, str) or not prompt.strip():
+                self._send_json(400, {"error": "A non-empty prompt is required"})
+                return
+            self._stream_interaction(prompt, session)
+        elif self.path == "/cancel":
+            self._send_json(200, {"cancelled": self.server.engine.cancel_interaction(session)})
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def _stream_interaction(self, prompt, session):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        events = self.server.engine.run_enhanced_interaction(prompt, session)
+        try:
+            for event in events:
+                self._send_event(event)
+            self._send_event({"type": "done"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client went away; closing the generator cancels the interaction
+        finally:
+            events.close()
+
+    def _send_event(self, event):
+        self.wfile.write(f"data: {json.dumps(event, default=str)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(host="127.0.0.1", port=8765, backend=BACKEND, projects_root=".", settings=None):
+    """Run the HTTP server until interrupted."""
+    engine = EnhancedMultiAgentSystem(load_api_key(), backend=backend)
+    for name, value in (settings or {}).items():
+        setattr(engine, name, value)
+    server = AgentServer((host, port), engine, projects_root)
+    print(f"Serving {APP_TITLE} on http://{host}:{server.server_port} (projects in {server.projects_root})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    """Command-line entry point: the Tk IDE by default, a headless batch run, or the HTTP server."""
+    parser = argparse.ArgumentParser(description=APP_TITLE)
+    parser.add_argument("--headless", action="store_true", help="Run prompts without the Tk UI")
+    parser.add_argument("--serve", action="store_true", help="Serve the engine over a local HTTP/SSE API")
+    parser.add_argument("--host", default="127.0.0.1", help="Server address (with --serve)")
+    parser.add_argument("--port", type=int, default=8765, help="Server port (with --serve)")
+    parser.add_argument("--projects-root", default=".", help="Directory that server projects must be inside")
+    parser.add_argument("--prompts", default="-", help="Prompt file (one per line, or .jsonl), or - for stdin")
+    parser.add_argument("--format", choices=["auto", "text", "jsonl"], default="auto",
+                        help="Prompt file format (auto: .jsonl files, or stdin starting with a JSON object)")
+    parser.add_argument("--project", action="append", help="Project directory (repeatable; default: vm)")
+    parser.add_argument("--output", default="-", help="JSONL event output file, or - for stdout")
+    parser.add_argument("--jobs", type=int, default=1, help="Project directories to run in parallel")
+    parser.add_argument("--backend", choices=["gemini", "local"], default=BACKEND)
+    parser.add_argument("--max-attempts", type=int, help="Main Coder attempts per prompt")
+    parser.add_argument("--max-seconds", type=float, help="Stop retrying once a prompt has run this long")
+    parser.add_argument("--max-tokens", type=int, help="Stop retrying once a prompt has used this many tokens")
+    parser.add_argument("--candidates", type=int, help="Best-of-N Main Coder candidates per prompt")
+    parser.add_argument("--image-concurrency", type=int, help="Image generations in flight at once")
+    parser.add_argument("--image-rpm", type=int, help="Image generation requests per minute (0 = no limit)")
+    parser.add_argument("--no-enhancer", action="store_true", help="Skip the prompt enhancer")
+    parser.add_argument("--no-grading", action="store_true", help="Skip the critics' grading")
+    parser.add_argument("--delta-context", action="store_true", help="Send only files changed since the cached project snapshot (needs context caching)")
+    parser.add_argument("--no-context-cache", action="store_true", help="Send stable prompt prefixes instead of caching them")
+    args = parser.parse_args(argv)
+
+    if not args.headless and not args.serve:
+        VM_DIR.mkdir(exist_ok=True)
+        app = EnhancedGeminiIDE()
+        app.mainloop()
+        return 0
+
+    settings = {}
+    if args.max_attempts:
+        settings["max_retry_attempts"] = args.max_attempts
+    if args.max_seconds:
+        settings["max_retry_seconds"] = args.max_seconds
+    if args.max_tokens:
+        settings["max_retry_tokens"] = args.max_tokens
+    if args.candidates:
+        settings["candidate_count"] = args.candidates
+    if args.image_concurrency:
+        settings["image_concurrency"] = args.image_concurrency
+    if args.image_rpm is not None:
+        settings["image_requests_per_minute"] = args.image_rpm or None
+    if args.no_enhancer:
+        settings["prompt_enhancer_enabled"] = False
+    if args.no_grading:
+        settings["grading_enabled"] = False
+    if args.delta_context:
+        settings["delta_context_enabled"] = True
+    if args.no_context_cache:
+        settings["context_caching_enabled"] = False
+
+    if args.serve:
+        serve(args.host, args.port, args.backend, args.projects_root, settings)
+        return 0
+
+    prompts = read_prompts(args.prompts, args.format)
+    if not prompts:
+        print("No prompts to run", file=sys.stderr)
+        return 1
+    project_dirs = args.project or [str(VM_DIR)]
+    summaries = run_headless_batch(project_dirs, prompts, args.output, args.jobs, args.backend, settings)
+
+    for summary in summaries:
+        usage = summary["usage"]
+        print(
+            f"{summary['project']}: {summary['prompts']} prompts, {summary['events']} events, "
+            f"{summary['errors']} errors, {usage['input_tokens']:,} in / {usage['output_tokens']:,} out tokens, "
+            f"{summary['seconds']}s",
+            file=sys.stderr
+        )
+    return 1 if any(summary["errors"] for summary in summaries) else 0
+
+
 # -----------------------------------------------------------------------------
 # Application Entry Point
 # -----------------------------------------------------------------------------
 if __name__ == "__main__":
-    VM_DIR.mkdir(exist_ok=True)
-    app = EnhancedGeminiIDE()
-    app.mainloop()
+    sys.exit(main())
@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import gemini_app  # noqa: E402
+
+
+@pytest.fixture
+def engine():
+    """Engine on the offline stand-in backend, with no injected latency or failures."""
+    return gemini_app.EnhancedMultiAgentSystem(
+        "test-key", backend="local", backend_options={"latency": 0, "jitter": 0, "failure_rate": 0}
+    )
+
+
+@pytest.fixture
+def session(engine, tmp_path):
+    """A session on an empty project directory, bound as the current session."""
+    session = gemini_app.AgentSession(tmp_path)
+    token = gemini_app.current_session.set(session)
+    yield session
+    gemini_app.current_session.reset(token)
@@ -0,0 +1,66 @@
+import asyncio
+import shutil
+from pathlib import Path
+
+
+def write(root, rel_path, text="x"):
+    path = Path(root) / rel_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def test_promotion_copies_changes_and_removes_emptied_directories(engine, session):
+    project = session.project_dir
+    write(project, "keep.txt")
+    write(project, "assets/old/sprite.txt")
+    write(project, "assets/kept/other.txt")
+    write(project, "logs/run.log")
+
+    scratch, baseline = engine._create_scratch_session(session)
+    try:
+        write(scratch.project_dir, "keep.txt", "changed")
+        write(scratch.project_dir, "src/new.py", "print()")
+        shutil.rmtree(scratch.project_dir / "assets" / "old")
+        (scratch.project_dir / "logs" / "run.log").unlink()  # Directory kept in the candidate's copy
+
+        changes = engine._scratch_changes(scratch, baseline)
+        assert changes == (["keep.txt", "src/new.py"], ["assets/old/sprite.txt", "logs/run.log"])
+        engine._promote_scratch(scratch, project, changes)
+    finally:
+        shutil.rmtree(scratch.project_dir, ignore_errors=True)
+
+    assert (project / "keep.txt").read_text() == "changed"
+    assert (project / "src" / "new.py").exists()
+    assert not (project / "assets" / "old").exists()
+    assert (project / "assets" / "kept" / "other.txt").exists()
+    assert (project / "logs").is_dir()
+
+
+def test_scan_tree_skips_files_removed_while_walking(engine, tmp_path, monkeypatch):
+    write(tmp_path, "a.txt")
+    write(tmp_path, "gone.tmp")
+    original_stat = Path.stat
+
+    def stat(path, *args, **kwargs):
+        if path.name == "gone.tmp":
+            raise FileNotFoundError(path)
+        return original_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(Path, "stat", stat)
+
+    assert list(engine._scan_tree(tmp_path)) == ["a.txt"]
+
+
+def test_best_of_n_promotes_a_candidate(engine, session):
+    write(session.project_dir, "index.html", "<p>hi</p>")
+    engine.candidate_count = 2
+    engine.prompt_enhancer_enabled = False
+
+    async def main():
+        return [event async for event in engine.run_interaction_async("make a page", session)]
+
+    events = asyncio.run(main())
+    messages = [event["content"] for event in events if event["type"] == "system"]
+
+    assert any(message.startswith("🏆 Promoting candidate") for message in messages)
+    assert not any(event["type"] == "error" for event in events)
@@ -0,0 +1,158 @@
+import asyncio
+import sys
+import time
+
+from gemini_app import CommandGraph
+
+
+def run_graph(commands, delays, workers=4):
+    """Run commands through a CommandGraph whose executor just sleeps.
+
+    Returns (results in hand-out order, log of ("start"|"end", command)).
+    """
+    log = []
+
+    async def run_command(command_str):
+        log.append(("start", command_str))
+        await asyncio.sleep(delays.get(command_str, 0))
+        log.append(("end", command_str))
+        yield command_str
+
+    async def main():
+        graph = CommandGraph(run_command, workers)
+        try:
+            for command_str in commands:
+                graph.add(command_str)
+            return [result async for result in graph.results()]
+        finally:
+            await graph.cancel()
+
+    return asyncio.run(main()), log
+
+
+def position(log, event, command_str):
+    return log.index((event, command_str))
+
+
+def test_writes_to_the_same_path_keep_their_order():
+    first = 'write_to_file("src/app.py", "one")'
+    second = 'write_to_file("src/./app.py", "two")'
+    results, log = run_graph([first, second], {first: 0.05})
+
+    assert results == [first, second]
+    assert position(log, "end", first) < position(log, "start", second)
+
+
+def test_writes_inside_a_deleted_directory_wait_for_the_delete():
+    delete = 'delete_file("assets")'
+    write = 'create_file("assets/logo.txt", "logo")'
+    results, log = run_graph([delete, write], {delete: 0.05})
+
+    assert results == [delete, write]
+    assert position(log, "end", delete) < position(log, "start", write)
+
+
+def test_writes_to_different_paths_overlap():
+    first = 'create_file("a.txt", "a")'
+    second = 'create_file("b.txt", "b")'
+    results, log = run_graph([first, second], {first: 0.05, second: 0.05})
+
+    assert results == [first, second]
+    assert position(log, "start", second) < position(log, "end", first)
+
+
+def test_results_come_out_in_command_order():
+    slow = 'create_file("slow.txt", "")'
+    fast = 'create_file("fast.txt", "")'
+    results, log = run_graph([slow, fast], {slow: 0.05})
+
+    assert position(log, "end", fast) < position(log, "end", slow)
+    assert results == [slow, fast]
+
+
+def test_worker_limit_serializes_independent_commands():
+    first = 'create_file("a.txt", "a")'
+    second = 'create_file("b.txt", "b")'
+    _, log = run_graph([first, second], {first: 0.05, second: 0.05}, workers=1)
+
+    assert position(log, "end", first) < position(log, "start", second)
+
+
+def test_run_command_waits_for_earlier_commands_and_blocks_later_ones():
+    before = 'create_file("a.txt", "a")'
+    barrier = 'run_command("python build.py")'
+    after = 'create_file("b.txt", "b")'
+    results, log = run_graph([before, barrier, after], {before: 0.05, barrier: 0.05})
+
+    assert results == [before, barrier, after]
+    assert position(log, "end", before) < position(log, "start", barrier)
+    assert position(log, "end", barrier) < position(log, "start", after)
+
+
+def test_command_paths():
+    assert CommandGraph.command_paths('create_file("dir/../a.txt", "")') == {"a.txt"}
+    assert CommandGraph.command_paths('run_command("ls")') is None
+    assert CommandGraph.command_paths('create_file(name, "")') == set()
+    assert CommandGraph.command_paths("not a command") == set()
+
+
+def test_engine_runs_a_response_in_command_order(engine, session):
+    response = "\n".join([
+        '`create_file("notes.txt", "draft")`',
+        '`create_file("other.txt", "other")`',
+        '`write_to_file("notes.txt", "final")`',
+        f'`run_command("{sys.executable} -c \'import os; print(sorted(os.listdir()))\'")`',
+        '`delete_file("other.txt")`',
+    ])
+
+    async def main():
+        return [result async for result in engine._process_enhanced_commands(response)]
+
+    results = asyncio.run(main())
+
+    assert len(results) == 5
+    assert (session.project_dir / "notes.txt").read_text() == "final"
+    assert not (session.project_dir / "other.txt").exists()
+    listing = results[3]["content"]
+    assert "'notes.txt', 'other.txt'" in listing
+
+
+def test_cancel_waits_for_running_commands_to_stop():
+    log = []
+
+    async def run_command(command_str):
+        try:
+            await asyncio.sleep(10)
+            yield command_str
+        finally:
+            await asyncio.sleep(0.01)  # Cleanup that must finish before cancel returns
+            log.append(("stopped", command_str))
+
+    async def main():
+        graph = CommandGraph(run_command)
+        graph.add('create_file("a.txt", "")')
+        graph.add('create_file("a.txt", "again")')  # Never starts
+        await asyncio.sleep(0.01)
+        await graph.cancel()
+        return list(log)
+
+    assert asyncio.run(main()) == [("stopped", 'create_file("a.txt", "")')]
+
+
+def test_cancelled_blocking_handler_finishes_before_raising(engine, tmp_path):
+    target = tmp_path / "slow.txt"
+
+    def slow_write():
+        time.sleep(0.1)
+        target.write_text("done")
+
+    async def main():
+        task = asyncio.create_task(engine._run_blocking(slow_write))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return target.exists()
+
+    assert asyncio.run(main()) is True
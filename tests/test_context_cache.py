@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from gemini_app import ContextCacheRegistry
+
+PREFIX = [{"text": "system prompt and project snapshot"}]
+
+
+class FakeAPIError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class FakeCaches:
+    """Records create calls; raises the queued errors first."""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.created = 0
+        self.deleted = []
+
+    async def create(self, model, config):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.created += 1
+        return SimpleNamespace(name=f"cachedContents/{self.created}")
+
+    async def delete(self, name):
+        self.deleted.append(name)
+
+
+def make_registry(errors=()):
+    caches = FakeCaches(errors)
+    client = SimpleNamespace(aio=SimpleNamespace(caches=caches))
+    return ContextCacheRegistry(client, min_tokens=10), caches
+
+
+def resolve(registry, prefix=PREFIX, slot="project:main_coder", tokens=2000):
+    return asyncio.run(registry.resolve(slot, "model", prefix, tokens))
+
+
+def test_new_prefix_is_cached_the_second_time_it_is_seen():
+    registry, caches = make_registry()
+
+    assert resolve(registry) is None
+    assert caches.created == 0
+    assert resolve(registry) == "cachedContents/1"
+    assert resolve(registry) == "cachedContents/1"
+    assert registry.stats()["deferred"] == 1
+    assert (registry.created, registry.reused) == (1, 1)
+
+
+def test_prefix_that_changes_every_call_is_never_cached():
+    registry, caches = make_registry()
+
+    for turn in range(4):
+        assert resolve(registry, prefix=[{"text": f"snapshot {turn}"}]) is None
+    assert caches.created == 0
+
+
+def test_expected_prefix_is_cached_on_first_sight():
+    registry, caches = make_registry()
+    registry.expect_reuse(registry.digest("model", PREFIX))
+
+    assert resolve(registry) == "cachedContents/1"
+
+
+def test_changed_prefix_deletes_the_old_cache():
+    registry, caches = make_registry()
+    resolve(registry)
+    resolve(registry)
+
+    assert resolve(registry, prefix=[{"text": "edited snapshot"}]) is None
+    assert caches.deleted == ["cachedContents/1"]
+    assert not registry.holds("project:main_coder", registry.digest("model", PREFIX))
+
+
+@pytest.mark.parametrize("error", [FakeAPIError(429), FakeAPIError(503), TimeoutError("timed out")])
+def test_transient_failure_is_retried_on_the_next_call(error):
+    registry, caches = make_registry([error])
+    registry.expect_reuse(registry.digest("model", PREFIX))
+
+    assert resolve(registry) is None
+    assert resolve(registry) == "cachedContents/1"
+    assert registry.failures == 1
+
+
+@pytest.mark.parametrize("code", [400, 403, 404])
+def test_refused_prefix_is_not_offered_again(code):
+    registry, caches = make_registry([FakeAPIError(code)])
+    registry.expect_reuse(registry.digest("model", PREFIX))
+
+    assert resolve(registry) is None
+    assert resolve(registry) is None
+    assert caches.created == 0
+    other = [{"text": "another prefix"}]
+    registry.expect_reuse(registry.digest("model", other))
+    assert resolve(registry, prefix=other) == "cachedContents/1"
+
+
+def test_small_prefixes_are_not_cached():
+    registry, caches = make_registry()
+
+    assert resolve(registry, tokens=5) is None
+    assert caches.created == 0
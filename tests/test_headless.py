@@ -0,0 +1,43 @@
+import io
+import json
+
+import pytest
+
+from gemini_app import read_prompts
+
+JSONL = "\n".join([
+    json.dumps({"prompt": "first line\nsecond line"}),
+    "",
+    json.dumps({"prompt": "another"}),
+])
+
+
+def test_stdin_jsonl_is_detected(monkeypatch):
+    monkeypatch.setattr("sys.stdin", io.StringIO(JSONL))
+
+    assert read_prompts("-") == ["first line\nsecond line", "another"]
+
+
+def test_stdin_text_stays_text(monkeypatch):
+    monkeypatch.setattr("sys.stdin", io.StringIO("# comment\nmake a game\n\n{not json}\n"))
+
+    assert read_prompts("-") == ["make a game", "{not json}"]
+
+
+@pytest.mark.parametrize("name, prompt_format, expected", [
+    ("prompts.jsonl", "auto", ["first line\nsecond line", "another"]),
+    ("prompts.txt", "auto", JSONL.replace("\n\n", "\n").splitlines()),
+    ("prompts.txt", "jsonl", ["first line\nsecond line", "another"]),
+    ("prompts.jsonl", "text", JSONL.replace("\n\n", "\n").splitlines()),
+])
+def test_file_format(tmp_path, name, prompt_format, expected):
+    path = tmp_path / name
+    path.write_text(JSONL, encoding="utf-8")
+
+    assert read_prompts(str(path), prompt_format) == expected
+
+
+def test_format_flag_applies_to_stdin(monkeypatch):
+    monkeypatch.setattr("sys.stdin", io.StringIO('{"prompt": "literal"}\n'))
+
+    assert read_prompts("-", "text") == ['{"prompt": "literal"}']
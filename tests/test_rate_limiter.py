@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+import pytest
+
+from gemini_app import RateLimiter
+
+
+async def hold(limiter, release):
+    async with limiter:
+        await release.wait()
+
+
+async def start_waiters(limiter, count, admitted):
+    """Start count waiters one after another; each records its index once admitted."""
+    async def waiter(index):
+        async with limiter:
+            admitted.append(index)
+
+    tasks = []
+    for index in range(count):
+        tasks.append(asyncio.create_task(waiter(index)))
+        await asyncio.sleep(0)  # Let it queue up before the next one arrives
+    return tasks
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    async def main():
+        limiter = RateLimiter(max_concurrent=1)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+        admitted = []
+        tasks = await start_waiters(limiter, 5, admitted)
+        assert limiter.stats()["waiting"] == 5
+
+        release.set()
+        await asyncio.gather(holder, *tasks)
+        return admitted
+
+    assert asyncio.run(main()) == [0, 1, 2, 3, 4]
+
+
+def test_max_concurrent_caps_requests_in_flight():
+    async def main():
+        limiter = RateLimiter(max_concurrent=3)
+        in_flight, peak = 0, 0
+
+        async def request():
+            nonlocal in_flight, peak
+            async with limiter:
+                in_flight += 1
+                peak = max(peak, in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+
+        await asyncio.gather(*[request() for _ in range(10)])
+        return peak, limiter.stats()
+
+    peak, stats = asyncio.run(main())
+    assert peak == 3
+    assert stats["active"] == 0 and stats["waiting"] == 0
+    assert stats["last_minute"] == 10
+
+
+def test_requests_per_minute_delays_until_the_window_frees_up():
+    async def main():
+        limiter = RateLimiter(max_concurrent=4, requests_per_minute=2)
+        # Two requests started just under a minute ago fill the budget for another 0.2s
+        limiter._starts.extend([time.monotonic() - 59.8] * 2)
+        started = time.monotonic()
+        async with limiter:
+            return time.monotonic() - started
+
+    waited = asyncio.run(main())
+    assert 0.15 <= waited < 1.0
+
+
+def test_requests_per_minute_does_not_delay_within_budget():
+    async def main():
+        limiter = RateLimiter(max_concurrent=4, requests_per_minute=2)
+        started = time.monotonic()
+        for _ in range(2):
+            async with limiter:
+                pass
+        return time.monotonic() - started
+
+    assert asyncio.run(main()) < 0.1
+
+
+@pytest.mark.parametrize("cancelled_index", [0, 1])
+def test_cancelled_waiter_leaves_the_queue_without_a_slot(cancelled_index):
+    async def main():
+        limiter = RateLimiter(max_concurrent=1)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(limiter, release))
+        await asyncio.sleep(0)
+        admitted = []
+        tasks = await start_waiters(limiter, 3, admitted)
+
+        tasks[cancelled_index].cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tasks[cancelled_index]
+        assert limiter.stats() == {"active": 1, "waiting": 2, "last_minute": 1}
+
+        release.set()
+        await asyncio.gather(holder, *[task for task in tasks if not task.cancelled()])
+        return admitted, limiter.stats()
+
+    admitted, stats = asyncio.run(main())
+    assert admitted == [index for index in range(3) if index != cancelled_index]
+    assert stats == {"active": 0, "waiting": 0, "last_minute": 3}
+
+
+def test_cancelled_waiter_during_rate_delay_frees_the_head():
+    async def main():
+        limiter = RateLimiter(max_concurrent=4, requests_per_minute=1)
+        limiter._starts.append(time.monotonic() - 59.9)
+        head = asyncio.create_task(limiter.__aenter__())
+        await asyncio.sleep(0.01)
+        head.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await head
+        return limiter.stats()
+
+    assert asyncio.run(main()) == {"active": 0, "waiting": 0, "last_minute": 1}
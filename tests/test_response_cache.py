@@ -0,0 +1,49 @@
+import os
+import time
+
+from google.genai import types
+
+from gemini_app import ResponseCache
+
+
+def make_response(text):
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))]
+    )
+
+
+def test_put_and_get_round_trip(tmp_path):
+    cache = ResponseCache(tmp_path)
+    key = cache.make_key("model", [{"text": "hello"}], None)
+    cache.put(key, make_response("hi"))
+
+    assert cache.get(key).text == "hi"
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_failed_write_removes_its_temp_file(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path)
+    key = cache.make_key("model", [{"text": "hello"}], None)
+
+    def failing_replace(source, destination):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    cache.put(key, make_response("hi"))
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_eviction_sweeps_stale_temp_files(tmp_path):
+    cache = ResponseCache(tmp_path)
+    stale = tmp_path / "abandoned.json.123.tmp"
+    fresh = tmp_path / "in-progress.json.456.tmp"
+    for path in (stale, fresh):
+        path.write_text("{}")
+    old = time.time() - ResponseCache.STALE_TEMP_SECONDS - 10
+    os.utime(stale, (old, old))
+
+    cache.put(cache.make_key("model", [{"text": "x"}], None), make_response("y"))
+
+    assert not stale.exists()
+    assert fresh.exists()
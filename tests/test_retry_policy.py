@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+from gemini_app import RetryPolicy, UsageLedger
+
+DEFAULTS = {"max_attempts": 3, "pass_grade": 70, "min_improvement": 5, "max_seconds": None, "max_tokens": None}
+
+
+@pytest.mark.parametrize("policy, grades, elapsed, tokens_used, retry, reason", [
+    ({}, [40], 1.0, 100, True, "below_pass_grade"),
+    ({}, [70], 1.0, 100, False, "passed"),
+    ({}, [50, 90], 1.0, 100, False, "passed"),
+    ({}, [40, 50, 60], 1.0, 100, False, "max_attempts"),
+    ({"max_attempts": 1}, [40], 1.0, 100, False, "max_attempts"),
+    ({}, [40, 44], 1.0, 100, False, "plateau"),  # Plateau is first possible on attempt 2
+    ({}, [40, 30], 1.0, 100, False, "plateau"),
+    ({}, [40, 45], 1.0, 100, True, "below_pass_grade"),
+    ({"max_seconds": 30}, [40], 30.0, 100, False, "time_budget"),
+    ({"max_seconds": 30}, [40], 29.9, 100, True, "below_pass_grade"),
+    ({"max_tokens": 1000}, [40], 1.0, 1000, False, "token_budget"),
+    ({"max_tokens": 1000}, [40], 1.0, 999, True, "below_pass_grade"),
+    ({"max_seconds": 30, "max_tokens": 1000}, [40, 42], 60.0, 5000, False, "plateau"),
+    ({"max_seconds": 30, "max_tokens": 1000}, [40], 60.0, 5000, False, "time_budget"),
+])
+def test_decide(policy, grades, elapsed, tokens_used, retry, reason):
+    decision = RetryPolicy(**{**DEFAULTS, **policy}).decide(grades, elapsed, tokens_used)
+
+    assert (decision["retry"], decision["reason"]) == (retry, reason)
+    assert decision["attempt"] == len(grades)
+    assert decision["improvement"] == (grades[-1] - grades[-2] if len(grades) > 1 else None)
+
+
+def test_token_budget_counts_cached_input_tokens():
+    # prompt_token_count includes the tokens served from a context cache
+    ledger = UsageLedger()
+    ledger.record("main_coder", "model", SimpleNamespace(
+        prompt_token_count=900, candidates_token_count=50, cached_content_token_count=800
+    ), latency=0.1)
+    usage = ledger.totals()
+    tokens_used = usage["input_tokens"] + usage["output_tokens"]
+
+    decision = RetryPolicy(max_tokens=900).decide([40], 1.0, tokens_used)
+
+    assert usage["cached_tokens"] == 800
+    assert (decision["retry"], decision["reason"]) == (False, "token_budget")
+
+
+@pytest.mark.parametrize("reason, grades, expected", [
+    ("passed", [80], "Grade acceptable"),
+    ("below_pass_grade", [40], "Attempt 2/3"),
+    ("max_attempts", [40, 50, 60], "Maximum attempts"),
+    ("plateau", [40, 42], "40 → 42"),
+    ("time_budget", [40], "Time budget spent"),
+    ("token_budget", [40], "Token budget spent"),
+])
+def test_describe(reason, grades, expected):
+    policy = RetryPolicy(max_seconds=30, max_tokens=1000)
+    decision = policy.decide(grades, 1.0, 10)
+    decision["reason"] = reason
+
+    assert expected in policy.describe(decision)
@@ -0,0 +1,61 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from gemini_app import AgentServer
+
+
+@pytest.fixture
+def server(engine, tmp_path):
+    server = AgentServer(("127.0.0.1", 0), engine, tmp_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, path, body=None):
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+    data = None if body is None else body.encode("utf-8")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+@pytest.mark.parametrize("body", [
+    "[1, 2]",
+    '"project"',
+    '{"project": 5}',
+    '{"project": "../outside"}',
+    "not json",
+])
+def test_bad_requests_get_400(server, body):
+    status, payload = request(server, "/cancel", body)
+
+    assert status == 400
+    assert payload["error"]
+
+
+def test_project_path_taken_by_a_file_gets_400(server, tmp_path):
+    (tmp_path / "taken").write_text("a file, not a project")
+
+    status, payload = request(server, "/cancel", '{"project": "taken"}')
+
+    assert status == 400
+    assert "taken" in payload["error"]
+    assert not server.sessions
+
+
+def test_cancel_and_status(server, tmp_path):
+    assert request(server, "/cancel", '{"project": "game"}') == (200, {"cancelled": False})
+    assert (tmp_path / "game").is_dir()
+
+    status, payload = request(server, "/status")
+    assert status == 200
+    assert [entry["project"] for entry in payload["sessions"]] == ["game"]